@@ -1,119 +1,201 @@
 import os
+import re
+import sys
+import mmap
+import binascii
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
-def detect_file_type(hex_string):
-    """Detect file type from hex data"""
-    # Remove 0x prefix if present
-    if hex_string.startswith("0x") or hex_string.startswith("0X"):
-        hex_string = hex_string[2:]
-    
-    # Get first few bytes
-    start = hex_string[:20].upper()
-    
-    if start.startswith('FFD8'):
-        return 'jpg', '.jpg'
-    elif start.startswith('89504E47'):
-        return 'png', '.png'
-    elif start.startswith('25504446'):  # %PDF
-        return 'pdf', '.pdf'
-    elif start.startswith('504B0304'):  # ZIP/Office docs
-        return 'zip', '.zip'
-    elif start.startswith('D0CF11E0'):  # Old Office docs
-        return 'doc', '.doc'
+HEX_DIGITS = b"0123456789abcdefABCDEF"
+# Every non-hex byte value, deleted from the input in one bytes.translate pass
+NON_HEX_BYTES = bytes(b for b in range(256) if b not in HEX_DIGITS)
+# Whitespace trimmed from the end of the input (e.g. the trailing newline in hex_data.txt)
+WHITESPACE = b" \t\r\n\x0b\x0c"
+# Leading whitespace and optional '0x' prefix in front of the hex digits
+HEX_PREFIX_RE = re.compile(rb"\s*(?:0[xX])?")
+# Magic bytes at the start of the decoded file -> (file type, extension)
+FILE_SIGNATURES = {
+    b'\xff\xd8': ('jpg', '.jpg'),
+    b'\x89PNG': ('png', '.png'),
+    b'%PDF': ('pdf', '.pdf'),
+    b'PK\x03\x04': ('zip', '.zip'),        # ZIP/Office docs
+    b'\xd0\xcf\x11\xe0': ('doc', '.doc'),  # Old Office docs
+}
+# Known types whose odd trailing hex digit is treated as a truncated byte and dropped
+TRUNCATE_ODD_TYPES = frozenset(('jpg', 'png', 'pdf'))
+# File type -> extension, for callers that already know what the dump contains
+FILE_EXTENSIONS = dict(FILE_SIGNATURES.values())
+# Hex digits decoded up front to detect the file type (16 bytes covers every signature)
+HEAD_DIGITS = 32
+# Amount of input processed per step when working through large dumps
+CHUNK_SIZE = 1 << 20
+# Blobs handed to each extract_many worker per round trip (amortizes IPC for small blobs)
+BATCH_CHUNKSIZE = 8
+
+def detect_file_type(data):
+    """Detect file type from the first decoded bytes of the file"""
+    return FILE_SIGNATURES.get(bytes(data[:4])) or FILE_SIGNATURES.get(bytes(data[:2])) or ('unknown', '.bin')
+
+def report_image(output_path, head, inspect):
+    """Print image dimensions (only when inspect is on, since it needs Pillow and a re-read)"""
+    if not inspect:
+        return
+    try:
+        from PIL import Image
+        with Image.open(output_path) as img:
+            print(f"📐 Image dimensions: {img.size[0]} x {img.size[1]} pixels")
+            print(f"🎨 Image mode: {img.mode}")
+    except ImportError:
+        print("💡 Install Pillow (pip install Pillow) to see image details")
+    except Exception as e:
+        print(f"⚠️  Could not read image details: {e}")
+
+def report_pdf(output_path, head, inspect):
+    """Print the PDF version line"""
+    # The version line ("%PDF-1.7") is already in the decoded head, no need to reopen the file
+    version = head.split(b'\n', 1)[0].split(b'\r', 1)[0].decode('ascii', errors='ignore').strip()
+    if version.startswith('%PDF-'):
+        print(f"📋 PDF version: {version}")
     else:
-        return 'unknown', '.bin'
+        print("⚠️  File may not be a valid PDF")
+
+# File type -> extra details printed after a verbose extraction
+FILE_REPORTERS = {
+    'jpg': report_image,
+    'png': report_image,
+    'pdf': report_pdf,
+}
+
+def strip_non_hex(hex_view):
+    """Copy only the hex digits out of a bytes-like buffer, one chunk at a time."""
+    cleaned = bytearray()
+    for start in range(0, len(hex_view), CHUNK_SIZE):
+        cleaned += bytes(hex_view[start:start + CHUNK_SIZE]).translate(None, NON_HEX_BYTES)
+    return cleaned
 
-def extract_file_from_hex(hex_string, output_path=None):
+def write_hex_chunks(hex_view, output_path):
+    """
+    Decode an even-length run of hex digits into output_path one chunk at a time.
+    The data goes to a temp file that replaces output_path only once every chunk decoded, so
+    invalid input (binascii.Error) leaves no file behind and never clobbers an existing one.
+    """
+    file_size = len(hex_view) // 2
+    tmp_path = os.fspath(output_path) + ".tmp"
+    # Unbuffered fd: each decoded chunk goes to the kernel in one write(2), no io-buffer copy
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, 'O_BINARY', 0), 0o644)
+    try:
+        # Reserve the final size up front so the filesystem does not fragment the file;
+        # single-chunk outputs go out in one write(2) anyway, so skip the extra syscall
+        if len(hex_view) > CHUNK_SIZE and hasattr(os, 'posix_fallocate'):
+            try:
+                os.posix_fallocate(fd, 0, file_size)
+            except OSError:
+                pass
+        for start in range(0, len(hex_view), CHUNK_SIZE):
+            chunk = memoryview(binascii.unhexlify(hex_view[start:start + CHUNK_SIZE]))
+            while chunk:
+                chunk = chunk[os.write(fd, chunk):]
+    except BaseException:
+        os.close(fd)
+        os.remove(tmp_path)
+        raise
+    os.close(fd)
+    os.replace(tmp_path, output_path)
+    return file_size
+
+def extract_file_from_hex(hex_string, output_path=None, verbose=False, output_stem="extracted_file", inspect=False, known_type=None):
     """
     Convert a hexadecimal string to a file.
     
     Args:
-        hex_string (str): Hexadecimal string representation of file data
+        hex_string (str or bytes-like): Hexadecimal representation of file data; ASCII bytes or an
+            mmap of the hex file avoid an extra decode/copy step
         output_path (str): Path where the file will be saved (auto-detected if None)
+        verbose (bool): Print progress and file details (main() turns this on; library callers stay quiet)
+        output_stem (str): File name (without extension) used when output_path is None
+        inspect (bool): With verbose, also open images with Pillow to report their dimensions
+        known_type (str): File type ('jpg', 'pdf', ...) when the caller already knows it; skips detection
     
     Returns:
         bool: True if successful, False otherwise
     """
     try:
-        # Remove the '0x' prefix if present
-        if hex_string.startswith("0x") or hex_string.startswith("0X"):
-            hex_string = hex_string[2:]
+        # Work on ASCII bytes throughout; str input is encoded once
+        if isinstance(hex_string, str):
+            hex_string = hex_string.encode('ascii', 'ignore')
+        hex_view = memoryview(hex_string)
+        
+        # Skip surrounding whitespace and remove the '0x' prefix if present
+        hex_view = hex_view[HEX_PREFIX_RE.match(hex_view).end():]
+        end = len(hex_view)
+        while end and hex_view[end - 1] in WHITESPACE:
+            end -= 1
+        hex_view = hex_view[:end]
         
         # Debug info
-        print(f"📊 Hex string length: {len(hex_string)} characters")
-        print(f"📊 First 50 characters: {hex_string[:50]}")
-        print(f"📊 Last 50 characters: {hex_string[-50:]}")
+        if verbose:
+            print(f"📊 Hex string length: {len(hex_view)} characters")
+            print(f"📊 First 50 characters: {bytes(hex_view[:50]).decode('ascii', 'replace')}")
+            print(f"📊 Last 50 characters: {bytes(hex_view[-50:]).decode('ascii', 'replace')}")
         
-        # Detect file type
-        file_type, extension = detect_file_type("0x" + hex_string)
-        print(f"🔍 Detected file type: {file_type.upper()}")
+        # Detect file type from the first few decoded bytes before cleaning the whole dump;
+        # with a known type the head is only needed for the verbose report
+        head = b""
+        if known_type is None or verbose:
+            head_digits = bytes(hex_view[:HEAD_DIGITS * 4]).translate(None, NON_HEX_BYTES)[:HEAD_DIGITS]
+            head = binascii.unhexlify(head_digits[:len(head_digits) // 2 * 2])
+        if known_type is None:
+            file_type, extension = detect_file_type(head)
+            if verbose:
+                print(f"🔍 Detected file type: {file_type.upper()}")
+        else:
+            file_type, extension = known_type, FILE_EXTENSIONS.get(known_type, '.bin')
         
         # Set output path if not provided
         if output_path is None:
-            output_path = f"extracted_file{extension}"
-        
-        # Remove any whitespace, newlines, or other non-hex characters
-        original_length = len(hex_string)
-        hex_string = ''.join(c for c in hex_string if c in '0123456789abcdefABCDEF')
-        cleaned_length = len(hex_string)
-        
-        if original_length != cleaned_length:
-            print(f"🧹 Removed {original_length - cleaned_length} non-hex characters")
-        
-        # Validate hex string format
-        if not hex_string:
-            raise ValueError("No valid hex characters found")
+            output_path = f"{output_stem}{extension}"
         
-        # Handle odd length
-        if len(hex_string) % 2 != 0:
-            if file_type in ['jpg', 'png', 'pdf']:  # Known file types
-                print(f"⚠️  Hex string has odd length ({len(hex_string)}), removing last character (likely incomplete)")
-                hex_string = hex_string[:-1]
-            else:
-                print(f"⚠️  Hex string has odd length ({len(hex_string)}), padding with leading zero")
-                hex_string = "0" + hex_string
-        
-        # Convert hex string to bytes
-        file_bytes = bytes.fromhex(hex_string)
+        # Dumps usually contain nothing but hex digits, so decode the input as-is first
+        # and only fall back to cleaning it when unhexlify rejects it
+        file_size = None
+        if hex_view and len(hex_view) % 2 == 0:
+            try:
+                file_size = write_hex_chunks(hex_view, output_path)
+            except binascii.Error:
+                pass
         
-        # Validate file headers
-        if file_type == 'jpg' and not file_bytes.startswith(b'\xff\xd8'):
-            print("Warning: Data doesn't appear to start with JPEG header")
-        elif file_type == 'pdf' and not file_bytes.startswith(b'%PDF'):
-            print("Warning: Data doesn't appear to start with PDF header")
-        elif file_type == 'png' and not file_bytes.startswith(b'\x89PNG'):
-            print("Warning: Data doesn't appear to start with PNG header")
+        if file_size is None:
+            # Remove any whitespace, newlines, or other non-hex characters
+            cleaned = strip_non_hex(hex_view)
+            
+            if verbose and len(hex_view) != len(cleaned):
+                print(f"🧹 Removed {len(hex_view) - len(cleaned)} non-hex characters")
+            
+            # Validate hex string format
+            if not cleaned:
+                raise ValueError("No valid hex characters found")
+            
+            # Handle odd length in place: slice the view or shift the buffer, never copy the dump
+            hex_digits = memoryview(cleaned)
+            if len(cleaned) % 2 != 0:
+                if file_type in TRUNCATE_ODD_TYPES:
+                    print(f"⚠️  Hex string has odd length ({len(cleaned)}), removing last character (likely incomplete)")
+                    hex_digits = hex_digits[:-1]
+                else:
+                    print(f"⚠️  Hex string has odd length ({len(cleaned)}), padding with leading zero")
+                    hex_digits.release()
+                    cleaned.insert(0, ord("0"))
+                    hex_digits = memoryview(cleaned)
+            
+            file_size = write_hex_chunks(hex_digits, output_path)
         
-        # Write to file
-        with open(output_path, "wb") as f:
-            f.write(file_bytes)
+        if verbose:
+            print(f"✅ {file_type.upper()} successfully saved to {output_path}")
+            print(f"📄 File size: {file_size:,} bytes")
         
-        print(f"✅ {file_type.upper()} successfully saved to {output_path}")
-        print(f"📄 File size: {len(file_bytes):,} bytes")
-        
-        # Try to get additional info based on file type
-        if file_type in ['jpg', 'png']:
-            try:
-                from PIL import Image
-                with Image.open(output_path) as img:
-                    print(f"📐 Image dimensions: {img.size[0]} x {img.size[1]} pixels")
-                    print(f"🎨 Image mode: {img.mode}")
-            except ImportError:
-                print("💡 Install Pillow (pip install Pillow) to see image details")
-            except Exception as e:
-                print(f"⚠️  Could not read image details: {e}")
-        
-        elif file_type == 'pdf':
-            # Basic PDF validation
-            try:
-                with open(output_path, 'rb') as f:
-                    first_line = f.readline().decode('ascii', errors='ignore')
-                    if first_line.startswith('%PDF-'):
-                        version = first_line.strip()
-                        print(f"📋 PDF version: {version}")
-                    else:
-                        print("⚠️  File may not be a valid PDF")
-            except Exception as e:
-                print(f"⚠️  Could not read PDF details: {e}")
+            # Try to get additional info based on file type
+            reporter = FILE_REPORTERS.get(file_type)
+            if reporter is not None:
+                reporter(output_path, head, inspect)
         
         return True
         
@@ -124,15 +206,57 @@ def extract_file_from_hex(hex_string, output_path=None):
         print(f"❌ Error: {e}")
         return False
 
+def _extract_one(job):
+    """Pool worker for extract_many: job is (hex_data, output_stem, verbose)"""
+    hex_data, output_stem, verbose = job
+    return extract_file_from_hex(hex_data, verbose=verbose, output_stem=output_stem)
+
+def extract_many(hex_blobs, out_dir, verbose=False, workers=None, threads=False):
+    """
+    Extract a batch of hex dumps (e.g. a column of blobs from a database export) into out_dir.
+    
+    Files are named extracted_file_<n><ext> in input order, with the extension auto-detected.
+    Blobs are independent, so they are spread over a process pool (workers defaults to the
+    CPU count; workers=1 runs them one after another in this process).
+    
+    threads=True uses a thread pool instead: blobs are not pickled to the workers (so large
+    buffers and mmaps are shared as-is) and the disk writes release the GIL, but the decode
+    itself still runs one thread at a time.
+    
+    Returns:
+        list: One success flag per input blob
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    jobs = [(hex_data, os.path.join(out_dir, f"extracted_file_{index}"), verbose)
+            for index, hex_data in enumerate(hex_blobs, start=1)]
+    workers = min(workers or os.cpu_count() or 1, len(jobs))
+    if workers <= 1:
+        return [_extract_one(job) for job in jobs]
+    if threads:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            return list(pool.map(_extract_one, jobs))
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(_extract_one, jobs, chunksize=BATCH_CHUNKSIZE))
+
 def main():
+    # Pass --inspect to also report image dimensions (needs Pillow)
+    inspect = "--inspect" in sys.argv[1:]
+    
     # Option 1: Read from file (RECOMMENDED for long hex strings)
     hex_file = "hex_data.txt"  # Create this file and paste your hex string there
     
     if os.path.exists(hex_file):
         print(f"📁 Reading hex data from {hex_file}...")
         try:
-            with open(hex_file, 'r') as f:
-                hex_string = f.read().strip()
+            with open(hex_file, 'rb') as f:
+                if os.fstat(f.fileno()).st_size == 0:
+                    # mmap can't map an empty file; let extraction report the missing hex data
+                    success = extract_file_from_hex(b"", verbose=True, inspect=inspect)
+                else:
+                    # Map the file instead of reading it so large dumps are paged in on demand
+                    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as hex_data:
+                        # Extract the file (auto-detects type and extension)
+                        success = extract_file_from_hex(hex_data, verbose=True, inspect=inspect)
         except Exception as e:
             print(f"❌ Error reading file: {e}")
             return
@@ -146,9 +270,9 @@ def main():
             print("1. Create a file called 'hex_data.txt' and paste your hex string there, OR")
             print("2. Replace 'PASTE_YOUR_HEX_STRING_HERE' with your hex data")
             return
-    
-    # Extract the file (auto-detects type and extension)
-    success = extract_file_from_hex(hex_string)
+        
+        # Extract the file (auto-detects type and extension)
+        success = extract_file_from_hex(hex_string, verbose=True, inspect=inspect)
     
     if success:
         print("✅ Extraction completed successfully!")
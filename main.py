@@ -1,62 +1,191 @@
 import os
 import json
+import io
+import asyncio
 import ollama
 import re
-import pandas as pd
+import csv
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from pdf2image import convert_from_path, pdfinfo_from_path
-from PIL import Image
-import time
+from pydantic import BaseModel
+from typing import List
+
+# orjson is optional: faster checkpoint reads/writes, falls back to the json module
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 # Path to the folder containing all PDFs
 SOURCE_FOLDER = "/home/shared/usacs_documents"
 # Name of the checkpoint file in the working directory
 CHECKPOINT_FILE = "processed_files.json"
+# Append-only log of filenames finished during a run; folded into CHECKPOINT_FILE at shutdown
+CHECKPOINT_LOG = "processed_files.log"
 # Name of the CSV where results are saved
 CSV_PATH = "data.csv"
-# Folder where temporary images will be written
-IMAGES_FOLDER = "images"
+# Chat requests in flight at once (and groups in inference); match the server's OLLAMA_NUM_PARALLEL
+# (start it with OLLAMA_NUM_PARALLEL=8 OLLAMA_MAX_LOADED_MODELS=1 so concurrent requests are batched on one model).
+# Server settings are per script: this one uses a single model; main_json_extractor.py needs =2
+OLLAMA_NUM_PARALLEL = int(os.environ.get("OLLAMA_NUM_PARALLEL", 4))
+# Width in pixels the vision model resizes images to; pages are rendered just wide enough for it
+MODEL_IMAGE_PX = 896
+# Lowest render DPI, so small print stays legible on narrow pages
+MIN_DPI = 100
+# JPEG quality for images sent to Ollama (PNG was ~10x larger on the wire)
+JPEG_QUALITY = 85
+# Page width and height in points from pdfinfo's "Page size" (e.g. "612 x 792 pts (letter)")
+PAGE_SIZE_RE = re.compile(r'([\d.]+)\s*x\s*([\d.]+)')
+# Longest header reply accepted per document; a valid one is well under 2 KB, anything far past
+# that is the model looping, and goes to the error path without being parsed
+MAX_RESPONSE_CHARS = 8192
+# Model answers that mean a field was not found (compared lowercased, after stripping)
+NA_SENTINELS = frozenset({'n/a', 'na', 'not available', 'not visible', '', 'unclear'})
+# Signature dates in model responses (MM/DD/YYYY, also M/D/YYYY)
+DATE_RE = re.compile(r'(\d{1,2}/\d{1,2}/\d{4})')
+# Everything except digits and slashes, stripped when salvaging a malformed date
+NON_DATE_CHARS_RE = re.compile(r'[^\d/]')
 model_name = "gemma3:27b"
 #model_name = "gemma3:4b"
+# Multi-page PDFs whose header crops are sent together in one structured request
+HEADER_BATCH_SIZE = 4
+# Processes rendering PDFs (Poppler + crop + JPEG encode) alongside inference
+RENDER_WORKERS = max(2, (os.cpu_count() or 2) // 2)
+# Groups rendered ahead of a free model slot, so the GPU never waits on Poppler
+PREFETCH_DEPTH = 4
+# Keep the model resident in VRAM for the whole run (-1 = never unload); avoids reload stalls
+# when a slow render leaves the server idle past its default 5 minute timeout
+OLLAMA_KEEP_ALIVE = -1
+# One client (one pooled, keep-alive HTTP connection set) shared by every request in the run
+ollama_client = ollama.AsyncClient()
+# Caps chat requests in flight across all groups at OLLAMA_NUM_PARALLEL; created inside the event loop
+ollama_slots = None
+# Worker processes rendering PDFs; created on first use and replaced if a worker dies (e.g. OOM-killed)
+render_pool = None
+
+# Header fields the model must return; passed to Ollama as format= so the reply is always this JSON
+class HeaderSchema(BaseModel):
+    patient_name: str
+    date_of_birth: str
+    gender: str
+    admit_date: str
+    discharge_date: str
+    attending_physician: str
+    location: str
+    facility_name: str
+    facility_address: str
+    facility_city: str
+    facility_state: str
+    facility_zip: str
+    document_name: str
+    document_status: str
+    performed_by: str
+    authenticated_by: str
+
+# Single-page PDFs: header fields plus the signature date read from the same page
+class SignedHeaderSchema(HeaderSchema):
+    electronically_signed_date: str
+
+# Several header crops in one request: one HeaderSchema per image, in image order
+class HeaderBatchSchema(BaseModel):
+    documents: List[HeaderSchema]
+
+# Several last-page images in one request: one signature date (or "N/A") per image, in image order
+class SignatureBatchSchema(BaseModel):
+    dates: List[str]
+
+# Where each header field is found; shared by the single and batched header prompts
+HEADER_FIELD_HINTS = """
+    Pay special attention to:
+    - Patient name: appears after "Patient:"
+    - DOB: appears after "DOB/Age/Sex:" in MM/DD/YYYY format
+    - Gender: appears after the age in the DOB/Age/Sex line (Male/Female/Other)
+    - Admit/Disch dates: appears after "Admit/Disch.:"; the first date is the admit date, the second
+      (if present) the discharge date, otherwise discharge date is N/A
+    - Attending physician: appears after "Attending:"
+    - Location: appears as "LD:" followed by location code (include the "LD:" prefix)
+    - Facility name: Use the specific medical center name (White Oak Medical Center), not the parent organization;
+      it is in bold text in the top right area above the facility street address, city, state and zip
+    - Document name: appears after "DOCUMENT NAME:" or can be inferred
+    - Document status: appears after "DOCUMENT STATUS:" or look for "Verified"/"Auth" status
+    - Performed by: who performed/created the document
+    - Authentication: appears in "AUTHENTICATED BY:" section (who authenticated it, with timestamp)
+"""
 
 def load_checkpoint():
-    """Load the set of already-processed filenames from JSON checkpoint."""
+    """Load the set of already-processed filenames from the JSON checkpoint plus the run log."""
+    processed = set()
     if os.path.exists(CHECKPOINT_FILE):
-        with open(CHECKPOINT_FILE, "r") as f:
-            processed_list = json.load(f)
-        return set(processed_list)
-    return set()
+        with open(CHECKPOINT_FILE, "rb") as f:
+            data = f.read()
+        processed.update(orjson.loads(data) if orjson else json.loads(data))
+    # Entries logged by a run that stopped before compacting
+    if os.path.exists(CHECKPOINT_LOG):
+        with open(CHECKPOINT_LOG, "r") as f:
+            processed.update(line.rstrip("\n") for line in f if line.strip())
+    return processed
 
 def save_checkpoint(processed_set):
-    """Write the processed filenames set back to the JSON checkpoint."""
-    with open(CHECKPOINT_FILE, "w") as f:
-        json.dump(sorted(processed_set), f, indent=2)
+    """Write the processed filenames set back to the JSON checkpoint and drop the run log."""
+    if orjson:
+        with open(CHECKPOINT_FILE, "wb") as f:
+            f.write(orjson.dumps(sorted(processed_set), option=orjson.OPT_INDENT_2))
+    else:
+        with open(CHECKPOINT_FILE, "w") as f:
+            json.dump(sorted(processed_set), f, indent=2)
+    if os.path.exists(CHECKPOINT_LOG):
+        os.remove(CHECKPOINT_LOG)
         #SHAH_47863014_20250521_Progress-Note-Physician_LANDMORGAN_RIEFONDIA_20250527_e6daed3e-76aa-4e91-ae87-5aa9b4c4aea9.pdf
 
-def crop_image_to_header(image_path, crop_fraction=0.33):
-    """Crop image to top portion (header section only)."""
+def crop_image_to_header(img, crop_fraction=0.33):
+    """Crop a page image (PIL) to its top portion (header section only); the page itself is left as-is."""
     try:
-        with Image.open(image_path) as img:
-            width, height = img.size
-            crop_height = int(height * crop_fraction)
-            crop_box = (0, 0, width, crop_height)
-            cropped_img = img.crop(crop_box)
-            cropped_img.save(image_path, "PNG")
-            print(f"  Cropped header image from {width}x{height} to {width}x{crop_height} (top {int(crop_fraction*100)}%)")
-            return image_path
+        width, height = img.size
+        crop_height = int(height * crop_fraction)
+        crop_box = (0, 0, width, crop_height)
+        cropped_img = img.crop(crop_box)
+        print(f"  Cropped header image from {width}x{height} to {width}x{crop_height} (top {int(crop_fraction*100)}%)")
+        return cropped_img
     except Exception as e:
-        print(f"  Warning: Failed to crop header image {image_path}: {e}")
-        return image_path
-
-def extract_electronic_signature_date(image_path, debug=False):
-    """Extract electronic signature date from last-page image via Ollama."""
+        print(f"  Warning: Failed to crop header image: {e}")
+        return img
+
+def get_ollama_slots():
+    """Return the shared request semaphore, creating it on first use (inside the running event loop)."""
+    global ollama_slots
+    if ollama_slots is None:
+        ollama_slots = asyncio.Semaphore(OLLAMA_NUM_PARALLEL)
+    return ollama_slots
+
+async def ollama_chat(**chat_args):
+    """ollama_client.chat, holding one of the OLLAMA_NUM_PARALLEL request slots for the call."""
+    async with get_ollama_slots():
+        return await ollama_client.chat(**chat_args)
+
+def image_to_bytes(img):
+    """Encode a PIL image as JPEG bytes, which Ollama accepts directly (no temporary file)."""
+    buf = io.BytesIO()
+    img.convert("RGB").save(buf, "JPEG", quality=JPEG_QUALITY)
+    return buf.getvalue()
+
+def render_dpi(info):
+    """Lowest DPI that still gives the model MODEL_IMAGE_PX across the page width."""
+    match = PAGE_SIZE_RE.search(str(info.get("Page size", "")))
+    page_width_in = float(match.group(1)) / 72 if match else 8.5  # Assume US letter
+    return max(MIN_DPI, int(MODEL_IMAGE_PX / page_width_in))
+
+async def extract_electronic_signature_date(image_bytes, debug=False):
+    """Extract electronic signature date from last-page image (encoded bytes) via Ollama."""
     if debug:
-        print(f"Extracting signature date from: {image_path}")
+        print(f"Extracting signature date from last page ({len(image_bytes):,} bytes)")
         print("=" * 60)
 
     try:
-        res = ollama.chat(
+        res = await ollama_chat(
             model=model_name,
+            keep_alive=OLLAMA_KEEP_ALIVE,
             messages=[
                 {
                     'role': 'user',
@@ -66,7 +195,7 @@ def extract_electronic_signature_date(image_path, debug=False):
                         'Extract just the date portion in MM/DD/YYYY format. '
                         'If you cannot find this text, respond with "N/A".'
                     ),
-                    'images': [image_path]
+                    'images': [image_bytes]
                 }
             ]
         )
@@ -77,29 +206,7 @@ def extract_electronic_signature_date(image_path, debug=False):
             print(response_text)
             print("=" * 60)
 
-        # Regex patterns for dates
-        date_patterns = [
-            r'(\d{2}/\d{2}/\d{4})',      # MM/DD/YYYY
-            r'(\d{1,2}/\d{1,2}/\d{4})',  # M/D/YYYY or variations
-        ]
-
-        for pattern in date_patterns:
-            matches = re.findall(pattern, response_text)
-            if matches:
-                extracted_date = matches[0]
-                if debug:
-                    print(f"EXTRACTED DATE: {extracted_date}")
-                return extracted_date
-
-        # Fallback: if response contains '/', try to clean up
-        if 'N/A' not in response_text and '/' in response_text:
-            cleaned = re.sub(r'[^\d/]', '', response_text)
-            if len(cleaned) >= 8 and cleaned.count('/') == 2:
-                return cleaned
-
-        if debug:
-            print("NO VALID DATE FOUND - returning N/A")
-        return "N/A"
+        return parse_signature_date(response_text, debug=debug)
 
     except Exception as e:
         if debug:
@@ -108,15 +215,85 @@ def extract_electronic_signature_date(image_path, debug=False):
             print(f"  ❌ ERROR extracting signature date: {e}")
         return "N/A"
 
+async def extract_signature_dates_batch(images, debug=False):
+    """
+    Extract signature dates for several last-page images (encoded bytes) in one Ollama request.
+    Returns one date (or "N/A") per image; falls back to one request per image if the reply
+    does not line up with the images.
+    """
+    batch_prompt = (
+        f'You are given {len(images)} images (Image 1 to Image {len(images)}), each the last page of a '
+        'different medical document. In each image find any text that says "ELECTRONICALLY SIGNED ON" '
+        'followed by a date and time, and extract just the date portion in MM/DD/YYYY format. '
+        'Return a "dates" list with exactly one entry per image, in the same order as the images; '
+        'use "N/A" for an image where you cannot find this text.'
+    )
+
+    try:
+        batch_res = await ollama_chat(
+            model=model_name,
+            keep_alive=OLLAMA_KEEP_ALIVE,
+            format=SignatureBatchSchema.model_json_schema(),
+            messages=[
+                {
+                    'role': 'user',
+                    'content': batch_prompt,
+                    'images': images
+                }
+            ]
+        )
+
+        response_text = batch_res['message']['content']
+        if debug:
+            print("BATCHED SIGNATURE EXTRACTION RESPONSE:")
+            print(response_text)
+            print("=" * 60)
+
+        check_response_size(response_text, documents=len(images))
+        dates = SignatureBatchSchema.model_validate_json(response_text).dates
+        if len(dates) != len(images):
+            raise ValueError(f"expected {len(images)} dates, got {len(dates)}")
+
+        return [parse_signature_date(date, debug=debug) for date in dates]
+
+    except Exception as e:
+        print(f"  ⚠️  Batched signature extraction failed ({e}), extracting one by one")
+        return list(await asyncio.gather(*(extract_electronic_signature_date(image, debug=debug) for image in images)))
+
+def check_response_size(response_text, documents):
+    """Reject empty or runaway model replies before parsing them (raises ValueError)."""
+    if not response_text.strip():
+        raise ValueError("Empty response from model")
+    if len(response_text) > MAX_RESPONSE_CHARS * documents:
+        raise ValueError(f"Response too large ({len(response_text):,} characters)")
+
+def parse_signature_date(response_text, debug=False):
+    """Pull the MM/DD/YYYY signature date out of a model response ("N/A" if there is none)."""
+    match = DATE_RE.search(response_text)
+    if match:
+        extracted_date = match.group(1)
+        if debug:
+            print(f"EXTRACTED DATE: {extracted_date}")
+        return extracted_date
+
+    # Fallback: if response contains '/', try to clean up
+    if 'N/A' not in response_text and '/' in response_text:
+        cleaned = NON_DATE_CHARS_RE.sub('', response_text)
+        if len(cleaned) >= 8 and cleaned.count('/') == 2:
+            return cleaned
+
+    if debug:
+        print("NO VALID DATE FOUND - returning N/A")
+    return "N/A"
+
 def validate_extracted_data(data):
     """Clean up and validate fields returned from Ollama extraction."""
-    validated = data.copy()
-
-    for key, value in validated.items():
-        if isinstance(value, str):
-            validated[key] = value.strip()
-            if value.lower() in ['n/a', 'na', 'not available', 'not visible', '', 'unclear']:
-                validated[key] = "N/A"
+    # Strip strings and map "not there" answers to N/A in one pass (builds the new dict directly)
+    validated = {
+        key: ("N/A" if (stripped := value.strip()).lower() in NA_SENTINELS else stripped)
+        if isinstance(value, str) else value
+        for key, value in data.items()
+    }
 
     # Document status inference
     if validated.get('document_status') == "N/A":
@@ -142,82 +319,48 @@ def validate_extracted_data(data):
 
     return validated
 
-def ollama_process_image(image_path, debug=False):
-    """Process first-page image: header cropping + two-step Ollama extraction."""
+async def ollama_process_image(header_image, debug=False, signature_image=None):
+    """
+    Process the first-page header crop (encoded bytes) with one structured Ollama extraction.
+    With signature_image (single-page PDFs: the full page) the signature date is read in the
+    same call and returned as "electronically_signed_date".
+    """
     if debug:
-        print(f"Processing header image: {image_path}")
+        print(f"Processing header image ({len(header_image):,} bytes)")
         print("=" * 60)
 
-    # Crop header portion
-    image_path = crop_image_to_header(image_path, crop_fraction=0.33)
-
-    # Step 1: Raw description prompt
-    res = ollama.chat(
-        model=model_name,
-        messages=[
-            {
-                'role': 'user',
-                'content': (
-                    'What do you see in this image? Describe all text you can read, '
-                    'including any medical document information, patient details, dates, '
-                    'and facility information.'
-                ),
-                'images': [image_path]
-            }
-        ]
-    )
-
-    if debug:
-        print("RAW MODEL RESPONSE:")
-        print(res['message']['content'])
-        print("=" * 60)
+    images = [header_image]
+
+    # Single-page PDFs: send the full page alongside the header crop and ask for the signature too
+    schema = HeaderSchema
+    signature_instructions = ""
+    if signature_image is not None:
+        images.append(signature_image)
+        schema = SignedHeaderSchema
+        signature_instructions = (
+            '- Electronic signature date: in the second (full page) image, find "ELECTRONICALLY SIGNED ON" '
+            'followed by a date and time; give just the date in MM/DD/YYYY format'
+        )
 
-    # Step 2: Structured JSON extraction
+    # Structured JSON extraction; the JSON shape itself is enforced through format=schema
     structured_prompt = f"""
-    Looking at this medical document image, please extract the following information and format it as JSON.
+    Looking at this medical document image, please extract the header information as JSON.
 
-    Pay special attention to:
-    - Patient name: appears after "Patient:"
-    - DOB: appears after "DOB/Age/Sex:" in MM/DD/YYYY format
-    - Gender: appears after the age in the DOB/Age/Sex line
-    - Admit/Disch dates: appears after "Admit/Disch.:" (this could be admission or discharge date)
-    - Attending physician: appears after "Attending:"
-    - Location: appears as "LD:" followed by location code (include the "LD:" prefix)
-    - Facility name: Use the specific medical center name (White Oak Medical Center), not the parent organization
-    - Document name: appears after "DOCUMENT NAME:" or can be inferred
-    - Document status: appears after "DOCUMENT STATUS:" or look for "Verified"/"Auth" status
-    - Authentication: appears in "AUTHENTICATED BY:" section
-
-    {{
-        "patient_name": "patient's full name",
-        "date_of_birth": "DOB in MM/DD/YYYY format",
-        "gender": "Male/Female/Other",
-        "admit_date": "first date from Admit/Disch field (before the / if two dates present)",
-        "discharge_date": "second date from Admit/Disch field (after the / if two dates present, otherwise N/A)",
-        "attending_physician": "attending doctor's name",
-        "location": "patient location including LD: prefix if present",
-        "facility_name": "facility name in bold text located in the top right area above the address",
-        "facility_address": "facility street address",
-        "facility_city": "facility city",
-        "facility_state": "facility state",
-        "facility_zip": "facility zip code",
-        "document_name": "type of document",
-        "document_status": "document status (look for Verified, Auth, etc.)",
-        "performed_by": "who performed/created the document",
-        "authenticated_by": "who authenticated the document with timestamp"
-    }}
+{HEADER_FIELD_HINTS}    {signature_instructions}
 
     If any field is not clearly visible, use "N/A". Only extract what you can clearly read.
     """
 
     try:
-        structured_res = ollama.chat(
+        structured_res = await ollama_chat(
             model=model_name,
+            keep_alive=OLLAMA_KEEP_ALIVE,
+            format=schema.model_json_schema(),
             messages=[
                 {
                     'role': 'user',
                     'content': structured_prompt,
-                    'images': [image_path]
+                    'images': images
                 }
             ]
         )
@@ -228,20 +371,10 @@ def ollama_process_image(image_path, debug=False):
             print("=" * 60)
 
         response_text = structured_res['message']['content']
+        check_response_size(response_text, documents=1)
 
-        # Extract the JSON block
-        if '```json' in response_text:
-            json_start = response_text.find('```json') + 7
-            json_end = response_text.find('```', json_start)
-            json_text = response_text[json_start:json_end].strip()
-        elif '{' in response_text and '}' in response_text:
-            json_start = response_text.find('{')
-            json_end = response_text.rfind('}') + 1
-            json_text = response_text[json_start:json_end]
-        else:
-            raise ValueError("No JSON found in response")
-
-        extracted_data = json.loads(json_text)
+        # The reply is constrained to the schema, so it parses directly (ValidationError is a ValueError)
+        extracted_data = schema.model_validate_json(response_text).model_dump()
 
         if debug:
             print("SUCCESSFULLY PARSED JSON:")
@@ -287,9 +420,9 @@ def ollama_process_image(image_path, debug=False):
 
     except Exception as e:
         if debug:
-            print(f"ERROR processing image {image_path}: {e}")
+            print(f"ERROR processing header image: {e}")
         else:
-            print(f"  ❌ ERROR processing image {image_path}: {e}")
+            print(f"  ❌ ERROR processing header image: {e}")
 
         error_data = {
             "patient_name": "EXTRACTION_FAILED",
@@ -311,75 +444,252 @@ def ollama_process_image(image_path, debug=False):
         }
         return error_data
 
-def convert_pdf_to_images(pdf_path, output_folder=IMAGES_FOLDER):
+async def ollama_process_image_batch(images, debug=False):
     """
-    Convert only the first page and last page of a PDF to PNG images.
-    Returns a dict: {'first': path_to_first, 'last': path_to_last}
+    Extract headers for several first-page header crops (encoded bytes) in one structured Ollama
+    request. Returns one validated dict per image; falls back to one request per image if the
+    reply does not line up with the images.
     """
-    if not os.path.exists(output_folder):
-        os.makedirs(output_folder)
 
-    # Clear any existing PNG/JPG files
-    for fname in os.listdir(output_folder):
-        if fname.lower().endswith((".png", ".jpg", ".jpeg")):
-            os.remove(os.path.join(output_folder, fname))
+    batch_prompt = f"""
+    You are given {len(images)} images (Image 1 to Image {len(images)}). Each one is the header of a
+    different medical document. Extract the header information from each image separately and return
+    a "documents" list with exactly one entry per image, in the same order as the images.
+{HEADER_FIELD_HINTS}
+    If any field is not clearly visible, use "N/A". Only extract what you can clearly read.
+    """
+
+    try:
+        batch_res = await ollama_chat(
+            model=model_name,
+            keep_alive=OLLAMA_KEEP_ALIVE,
+            format=HeaderBatchSchema.model_json_schema(),
+            messages=[
+                {
+                    'role': 'user',
+                    'content': batch_prompt,
+                    'images': images
+                }
+            ]
+        )
+
+        if debug:
+            print("BATCHED EXTRACTION ATTEMPT:")
+            print(batch_res['message']['content'])
+            print("=" * 60)
+
+        response_text = batch_res['message']['content']
+        check_response_size(response_text, documents=len(images))
+        documents = HeaderBatchSchema.model_validate_json(response_text).documents
+        if len(documents) != len(images):
+            raise ValueError(f"expected {len(images)} documents, got {len(documents)}")
 
+        return [validate_extracted_data(document.model_dump()) for document in documents]
+
+    except Exception as e:
+        print(f"  ⚠️  Batched header extraction failed ({e}), extracting one by one")
+        return list(await asyncio.gather(*(ollama_process_image(image, debug=debug) for image in images)))
+
+def convert_pdf_to_images(pdf_path):
+    """
+    Convert only the first page and last page of a PDF to in-memory PIL images.
+    Returns a dict: {'first': first_page_image, 'last': last_page_image}
+    """
     try:
         # Get page count via pdfinfo_from_path (Poppler must be installed)
         info = pdfinfo_from_path(pdf_path)
         total_pages = info.get("Pages", 0)
+        dpi = render_dpi(info)
+
+        # Render first and last page at the same time (two independent pdftoppm runs);
+        # pages come back over a pipe as raw PPM, so nothing touches the disk.
+        # thread_count would not help: pdf2image splits work by page and each call renders one page
+        pages = {"first": 1, "last": total_pages} if total_pages > 1 else {"first": 1}
+        with ThreadPoolExecutor(max_workers=len(pages)) as pool:
+            futures = {
+                key: pool.submit(convert_from_path, pdf_path, dpi=dpi, first_page=page, last_page=page)
+                for key, page in pages.items()
+            }
+            page_images = {key: future.result()[0] for key, future in futures.items()}
 
-        image_paths = {}
-
-        # Convert first page only
-        first_page_images = convert_from_path(pdf_path, first_page=1, last_page=1)
-        first_page_path = os.path.join(output_folder, "page_1.png")
-        first_page_images[0].save(first_page_path, "PNG")
-        image_paths["first"] = first_page_path
-
-        # Convert last page only (if more than one page)
-        if total_pages > 1:
-            last_page_images = convert_from_path(
-                pdf_path, first_page=total_pages, last_page=total_pages
-            )
-            last_page_path = os.path.join(output_folder, f"page_{total_pages}.png")
-            last_page_images[0].save(last_page_path, "PNG")
-            image_paths["last"] = last_page_path
-        else:
+        if total_pages <= 1:
             # Single-page PDF: reuse first-page image
-            image_paths["last"] = first_page_path
+            page_images["last"] = page_images["first"]
 
-        print(f"  📄 Converted PDF ({total_pages} pages) → first & last page images")
-        return image_paths
+        print(f"  📄 Converted PDF ({total_pages} pages, {dpi} DPI) → first & last page images")
+        return page_images
 
     except Exception as e:
         print(f"  ❌ ERROR converting PDF {pdf_path}: {e}")
         return {}
 
-def main():
-    # Ensure images folder exists
-    if not os.path.exists(IMAGES_FOLDER):
-        os.makedirs(IMAGES_FOLDER)
+def render_pdf_for_model(pdf_path):
+    """
+    Render a PDF's first and last page and encode what the model needs (runs in a worker process).
+    Returns {'header': header crop JPEG, 'last': last page JPEG, 'single_page': bool}, or {} on failure;
+    for single-page PDFs 'last' is the full first page.
+    """
+    page_images = convert_pdf_to_images(pdf_path)
+    if not page_images or "first" not in page_images:
+        return {}
+    return {
+        "header": image_to_bytes(crop_image_to_header(page_images["first"], crop_fraction=0.33)),
+        "last": image_to_bytes(page_images["last"]),
+        "single_page": page_images["last"] is page_images["first"],
+    }
+
+def get_render_pool():
+    """Return the shared render pool, creating it on first use."""
+    global render_pool
+    if render_pool is None:
+        render_pool = ProcessPoolExecutor(max_workers=RENDER_WORKERS)
+    return render_pool
+
+def replace_broken_render_pool(broken_pool):
+    """Swap a broken render pool for a fresh one (once, however many groups saw it break)."""
+    global render_pool
+    if render_pool is broken_pool:
+        print("  ⚠️  A render worker died, restarting the render pool")
+        broken_pool.shutdown(wait=False, cancel_futures=True)
+        render_pool = ProcessPoolExecutor(max_workers=RENDER_WORKERS)
+
+async def render_in_pool(pdf_path):
+    """Run render_pdf_for_model in the render pool, retrying once on a fresh pool if a worker died."""
+    loop = asyncio.get_running_loop()
+    for attempt in range(2):
+        pool = get_render_pool()
+        try:
+            return await loop.run_in_executor(pool, render_pdf_for_model, pdf_path)
+        except BrokenProcessPool:
+            replace_broken_render_pool(pool)
+            if attempt:
+                raise
+
+async def process_batch(filenames, semaphore, prefetch):
+    """
+    Render and extract a group of PDFs; returns a list of (filename, header_info, error).
+    header_info is None when a PDF failed; error is None when it could not be converted.
+    """
+    async with prefetch:
+        for filename in filenames:
+            print(f"  ▶️  Processing: {filename}")
+
+        # Convert first and last pages in the render pool; only the encoded JPEGs come back, and
+        # groups waiting for a model slot are rendered ahead while other groups are in inference
+        rendered = await asyncio.gather(
+            *(render_in_pool(os.path.join(SOURCE_FOLDER, filename)) for filename in filenames),
+            return_exceptions=True,
+        )
+
+        results = {}
+        single_page = []
+        multi_page = []
+        for filename, pages in zip(filenames, rendered):
+            if isinstance(pages, Exception):
+                # A render failure is a conversion failure: not checkpointed, so the next run retries it
+                print(f"  ❌ ERROR rendering {filename}: {pages}")
+                results[filename] = (filename, None, None)
+            elif not pages:
+                results[filename] = (filename, None, None)
+            elif pages["single_page"]:
+                single_page.append((filename, pages))
+            else:
+                multi_page.append((filename, pages))
+
+        async def extract_single(filename, pages):
+            # Single-page PDF: header and signature date come back from one call
+            header_info = await ollama_process_image(
+                pages["header"], debug=False, signature_image=pages["last"]
+            )
+            sig_date = parse_signature_date(header_info.get("electronically_signed_date", "N/A"))
+            return header_info, sig_date
+
+        async def extract_headers():
+            # Multi-page PDFs: all first-page headers in one request
+            if not multi_page:
+                return []
+            if len(multi_page) == 1:
+                return [await ollama_process_image(multi_page[0][1]["header"], debug=False)]
+            return await ollama_process_image_batch([pages["header"] for _, pages in multi_page])
+
+        async def extract_signatures():
+            # Multi-page PDFs: all last-page signature dates in one request
+            if not multi_page:
+                return []
+            if len(multi_page) == 1:
+                return [await extract_electronic_signature_date(multi_page[0][1]["last"], debug=False)]
+            return await extract_signature_dates_batch([pages["last"] for _, pages in multi_page])
+
+        async with semaphore:
+            outcomes = await asyncio.gather(
+                *(extract_single(filename, pages) for filename, pages in single_page),
+                extract_headers(),
+                extract_signatures(),
+                return_exceptions=True,
+            )
+        single_outcomes = outcomes[:len(single_page)]
+        batch_headers, batch_sig_dates = outcomes[len(single_page):]
+
+        extracted = [(filename, outcome) for (filename, _), outcome in zip(single_page, single_outcomes)]
+        for i, (filename, _) in enumerate(multi_page):
+            header_info = batch_headers if isinstance(batch_headers, Exception) else batch_headers[i]
+            sig_date = batch_sig_dates if isinstance(batch_sig_dates, Exception) else batch_sig_dates[i]
+            if isinstance(header_info, Exception):
+                extracted.append((filename, header_info))
+            elif isinstance(sig_date, Exception):
+                extracted.append((filename, sig_date))
+            else:
+                extracted.append((filename, (header_info, sig_date)))
+
+        for filename, outcome in extracted:
+            if isinstance(outcome, Exception):
+                results[filename] = (filename, None, outcome)
+                continue
+            header_info, sig_date = outcome
+            # Combine results
+            header_info["electronically_signed_date"] = sig_date
+            header_info["document_name"] = filename
+            header_info["processed_timestamp"] = datetime.now().isoformat()
+            results[filename] = (filename, header_info, None)
+
+        return [results[filename] for filename in filenames]
+
+async def finished_pdfs(tasks):
+    """Yield (filename, header_info, error) for every PDF as its batch completes."""
+    for task in asyncio.as_completed(tasks):
+        for result in await task:
+            yield result
 
+async def main():
     # Load checkpoint
     processed = load_checkpoint()
 
-    # Fetch list of all PDFs in source folder
-    all_pdfs = [
-        fname for fname in os.listdir(SOURCE_FOLDER)
-        if fname.lower().endswith(".pdf")
-    ]
-
-    # Filter out already-processed
-    to_process = [f for f in all_pdfs if f not in processed]
+    # Fetch unprocessed PDFs in one pass over the source folder; scandir entries carry the
+    # file type, so no per-file stat is needed
+    total_pdfs = 0
+    to_process = []
+    with os.scandir(SOURCE_FOLDER) as entries:
+        for entry in entries:
+            if entry.name.lower().endswith(".pdf") and entry.is_file():
+                total_pdfs += 1
+                if entry.name not in processed:
+                    to_process.append(entry.name)
 
     if not to_process:
         print("No unprocessed PDF files found in the source folder.")
         return
 
-    print(f"Found {len(all_pdfs)} total PDFs, {len(to_process)} to process")
+    print(f"Found {total_pdfs} total PDFs, {len(to_process)} to process")
+    print(f"Processing up to {OLLAMA_NUM_PARALLEL} groups of {HEADER_BATCH_SIZE} PDFs concurrently")
     print("=" * 50)
 
+    # Load the model before the first PDF so no request pays for it
+    try:
+        print(f"🔥 Loading model {model_name}...")
+        await ollama_client.generate(model=model_name, keep_alive=OLLAMA_KEEP_ALIVE)
+    except Exception as e:
+        print(f"  ⚠️  Could not preload model: {e}")
+
     # Prepare CSV: if it doesn't exist, write headers now
     expected_columns = [
         "patient_name", "date_of_birth", "gender", "admit_date", "discharge_date",
@@ -387,65 +697,60 @@ def main():
         "facility_city", "facility_state", "facility_zip", "document_name",
         "document_status", "performed_by", "authenticated_by", "electronically_signed_date"
     ]
-    if not os.path.exists(CSV_PATH):
-        # Create empty DataFrame with headers
-        pd.DataFrame(columns=expected_columns).to_csv(CSV_PATH, index=False)
+    # Rows are streamed onto one open handle; missing fields are written as "N/A"
+    write_header = not os.path.exists(CSV_PATH)
+    csv_file = open(CSV_PATH, "a", newline="")
+    csv_writer = csv.DictWriter(csv_file, fieldnames=expected_columns, restval="N/A", extrasaction="ignore")
+    if write_header:
+        csv_writer.writeheader()
 
     # Track counts and time
     successful_count = 0
     error_count = 0
     start_time = datetime.now()
 
-    for idx, filename in enumerate(to_process, start=1):
-        print(f"[{idx}/{len(to_process)}] Processing: {filename}")
-        pdf_path = os.path.join(SOURCE_FOLDER, filename)
+    # All PDFs are scheduled up front in groups of HEADER_BATCH_SIZE; the semaphore caps how many
+    # groups are in inference (each group sends several requests, which ollama_chat caps separately),
+    # prefetch how many are rendered or waiting, and results are written in the order they finish
+    semaphore = asyncio.Semaphore(OLLAMA_NUM_PARALLEL)
+    prefetch = asyncio.Semaphore(OLLAMA_NUM_PARALLEL + PREFETCH_DEPTH)
+    tasks = [
+        process_batch(to_process[i:i + HEADER_BATCH_SIZE], semaphore, prefetch)
+        for i in range(0, len(to_process), HEADER_BATCH_SIZE)
+    ]
 
-        try:
-            # Convert first and last pages
-            image_paths = convert_pdf_to_images(pdf_path, IMAGES_FOLDER)
-            if not image_paths or "first" not in image_paths:
-                print("  ❌ ERROR: Failed to convert PDF to images")
+    # One line per finished PDF instead of rewriting the whole JSON checkpoint each time
+    checkpoint_log = open(CHECKPOINT_LOG, "a")
+    try:
+        idx = 0
+        async for filename, header_info, error in finished_pdfs(tasks):
+            idx += 1
+            print(f"[{idx}/{len(to_process)}] Finished: {filename}")
+
+            if header_info is None:
                 error_count += 1
+                if error is None:
+                    print("  ❌ ERROR: Failed to convert PDF to images")
+                else:
+                    print(f"  ❌ ERROR processing {filename}: {error}")
+                    # Still save checkpoint so we don’t retry on next run
+                    processed.add(filename)
+                    checkpoint_log.write(filename + "\n")
+                    checkpoint_log.flush()
                 continue
 
-            # start_convert = time.time()
-            # image_paths = convert_pdf_to_images(pdf_path, IMAGES_FOLDER)
-            # convert_time = time.time() - start_convert
-
-            # start_header = time.time()
-            # header_info = ollama_process_image(image_paths["first"], debug=False)
-            # header_time = time.time() - start_header
-
-            # start_sig = time.time()
-            # sig_date = extract_electronic_signature_date(image_paths["last"], debug=False)
-            # sig_time = time.time() - start_sig
-
-            #print(f"  PDF Convert: {convert_time:.1f}s | Header Extract: {header_time:.1f}s | Sig Extract: {sig_time:.1f}s")
-
-            # Extract header data from first page
-            print("  📋 Extracting header info...")
-            header_info = ollama_process_image(image_paths["first"], debug=False)
-
-            # Extract signature date from last page
-            print("  ✍️  Extracting signature date...")
-            sig_date = extract_electronic_signature_date(image_paths["last"], debug=False)
-
-            # Combine results
-            header_info["electronically_signed_date"] = sig_date
-            header_info["document_name"] = filename
-            header_info["processed_timestamp"] = datetime.now().isoformat()
-
             # Append a row to CSV
-            row_df = pd.DataFrame([[header_info.get(col, "N/A") for col in expected_columns]],
-                                  columns=expected_columns)
-            row_df.to_csv(CSV_PATH, mode="a", header=False, index=False)
+            csv_writer.writerow(header_info)
+            csv_file.flush()
 
             # Mark as processed and update checkpoint
             processed.add(filename)
-            save_checkpoint(processed)
+            checkpoint_log.write(filename + "\n")
+            checkpoint_log.flush()
 
             successful_count += 1
             patient_name = header_info.get("patient_name", "Unknown")
+            sig_date = header_info["electronically_signed_date"]
             sig_out = sig_date if sig_date != "N/A" else "No signature"
             print(f"  ✅ SUCCESS: {patient_name} | Sig: {sig_out}")
 
@@ -456,14 +761,12 @@ def main():
                 remaining = len(to_process) - idx
                 est_remaining = avg_time * remaining / 60  # minutes
                 print(f"  ⏱️  Progress: {successful_count}/{len(to_process)} | Est. remaining: {est_remaining:.1f} min")
-
-        except Exception as e:
-            print(f"  ❌ ERROR processing {filename}: {e}")
-            error_count += 1
-            # Still save checkpoint so we don’t retry on next run
-            processed.add(filename)
-            save_checkpoint(processed)
-            continue
+    finally:
+        if render_pool is not None:
+            render_pool.shutdown(cancel_futures=True)
+        csv_file.close()
+        checkpoint_log.close()
+        save_checkpoint(processed)
 
     # Final summary
     total_time = datetime.now() - start_time
@@ -483,6 +786,5 @@ if __name__ == "__main__":
     print(f"Source folder: {SOURCE_FOLDER}")
     print(f"Checkpoint file: {CHECKPOINT_FILE}")
     print(f"Output CSV: {CSV_PATH}")
-    print(f"Images temporary folder: {IMAGES_FOLDER}")
     print("=" * 60)
-    main()
+    asyncio.run(main())
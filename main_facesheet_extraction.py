@@ -1,20 +1,74 @@
 import os
+import re
 import json
-import ollama
-import pandas as pd
-from datetime import datetime
-from pdf2image import convert_from_path, pdfinfo_from_path
-from PIL import Image
-from pydantic import BaseModel
-from typing import List, Optional
+import asyncio
+import hashlib
 import time
+from datetime import datetime, timedelta
+import pymupdf
+from pydantic import BaseModel, TypeAdapter, ValidationError
+from typing import List, Optional
+from concurrent.futures import ProcessPoolExecutor
+
+# orjson is optional: faster checkpoint, cache and schema reads/writes, falls back to the json module
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 # Configuration - Updated for your test setup
 SOURCE_FOLDER = "facesheet_pdfs"  # Your new test folder
 CHECKPOINT_FILE = "processed_facesheets.json"
+# Append-only log of files finished this run; folded into CHECKPOINT_FILE when the run ends
+CHECKPOINT_LOG = "processed_facesheets.log"
+# Fold the log into CHECKPOINT_FILE after this many entries, so it never grows without bound
+CHECKPOINT_COMPACT_EVERY = 1000
 OUTPUT_FOLDER = "facesheet_json_output"
-IMAGES_FOLDER = "facesheet_images"
-model_name = "gemma3:27b"
+# Model replies keyed by model, prompt and PDF contents, so re-runs skip unchanged PDFs
+CACHE_FOLDER = "facesheet_cache"
+# Quantization pinned explicitly (the bare gemma3:27b tag resolves to this build today): Q4_K_M is
+# the fast choice; if field recall drops on your facesheets, switch to "gemma3:27b-it-q8_0"
+model_name = "gemma3:27b-it-q4_K_M"
+# Requests in flight at once. OLLAMA_NUM_PARALLEL is read by the Ollama *server*, so start it with
+# the same value (e.g. OLLAMA_NUM_PARALLEL=4 OLLAMA_MAX_LOADED_MODELS=1 ollama serve, so concurrent
+# requests are batched on one loaded model); setting it here only sizes the client. Server settings
+# are per script: this one uses a single model; main_json_extractor.py needs OLLAMA_MAX_LOADED_MODELS=2
+OLLAMA_NUM_PARALLEL = int(os.environ.get("OLLAMA_NUM_PARALLEL", 4))
+# How long the server keeps the model loaded after each request, so it stays resident for the batch
+OLLAMA_KEEP_ALIVE = "30m"
+# Same context size on every request (a different num_ctx makes the server reload the model); room
+# for a full batch of page images, the prompt and a reply per document
+OLLAMA_OPTIONS = {"num_ctx": 16384}
+# One client shared by every request (async, so several PDFs can wait on the server at once);
+# created on first use so --schema-only / --view-schema don't import ollama
+ollama_client = None
+# Caps requests in flight at OLLAMA_NUM_PARALLEL across all groups, including the per-document
+# fallback; created on first use inside the running event loop
+ollama_slots = None
+# PDFs rendered ahead of a free inference slot, so the next file's pages are ready when one finishes
+PREFETCH_DEPTH = 2
+# Facesheets sent to the model in one request (fewer round trips per PDF)
+FACESHEET_BATCH_SIZE = 4
+# Batches with more pages than this are extracted one document per request instead,
+# so the images and prompt stay within the model's context window
+MAX_BATCH_PAGES = 8
+# Highest page render resolution (small pages); the model downsamples images to a fixed grid,
+# so there is nothing to gain from more
+RENDER_DPI = 150
+# Longest side of a rendered page in pixels; gemma3 resizes every image to 896x896, so larger
+# renders (big page sizes, or RENDER_DPI on letter paper) only add bytes
+MAX_IMAGE_PX = 1024
+# JPEG quality for rendered pages; far smaller and faster to encode than PNG, and the model
+# gains nothing from lossless pixels
+JPEG_QUALITY = 85
+# Render pages in grayscale: facesheets are black-and-white forms, and one channel instead of
+# three makes both the render and the JPEG encode cheaper
+RENDER_GRAYSCALE = True
+# Page text that marks a facesheet page (header, insurance or guarantor sections); pages with a
+# text layer that match none of these (consent forms, instructions) are not sent to the model
+FACESHEET_PAGE_RE = re.compile(r"\b(?:MRN|Medical Record|Account|Insurance|Guarantor|Policy)\b", re.IGNORECASE)
+# Processes rendering PDFs alongside inference (each renders whole files, one page after another)
+RENDER_WORKERS = max(1, (os.cpu_count() or 2) // 2)
 
 # Updated Pydantic Models - FLATTENED STRUCTURE
 class Address(BaseModel):
@@ -96,64 +150,8 @@ class FacesheetObject(BaseModel):
     processed_timestamp: Optional[str] = None
     source_filename: Optional[str] = None
 
-def load_checkpoint():
-    """Load the set of already-processed filenames from JSON checkpoint."""
-    if os.path.exists(CHECKPOINT_FILE):
-        with open(CHECKPOINT_FILE, "r") as f:
-            processed_list = json.load(f)
-        return set(processed_list)
-    return set()
-
-def save_checkpoint(processed_set):
-    """Write the processed filenames set back to the JSON checkpoint."""
-    with open(CHECKPOINT_FILE, "w") as f:
-        json.dump(sorted(processed_set), f, indent=2)
-
-def convert_pdf_to_images(pdf_path, output_folder=IMAGES_FOLDER):
-    """
-    Convert ALL pages of a PDF to PNG images for facesheet processing.
-    Returns a list of image paths.
-    """
-    if not os.path.exists(output_folder):
-        os.makedirs(output_folder)
-
-    # Clear any existing PNG/JPG files
-    for fname in os.listdir(output_folder):
-        if fname.lower().endswith((".png", ".jpg", ".jpeg")):
-            os.remove(os.path.join(output_folder, fname))
-
-    try:
-        # Get page count
-        info = pdfinfo_from_path(pdf_path)
-        total_pages = info.get("Pages", 0)
-
-        # Convert ALL pages
-        images = convert_from_path(pdf_path)
-        image_paths = []
-        
-        for i, image in enumerate(images, 1):
-            image_path = os.path.join(output_folder, f"page_{i}.png")
-            image.save(image_path, "PNG")
-            image_paths.append(image_path)
-
-        print(f"  📄 Converted PDF ({total_pages} pages) → {len(image_paths)} images")
-        return image_paths
-
-    except Exception as e:
-        print(f"  ❌ ERROR converting PDF {pdf_path}: {e}")
-        return []
-
-def extract_facesheet_data(image_paths, debug=False):
-    """
-    Extract comprehensive facesheet data from all page images using Ollama.
-    Returns extracted data as a dictionary with FLATTENED structure.
-    """
-    if debug:
-        print(f"Processing {len(image_paths)} facesheet images")
-        print("=" * 60)
-
-    # First pass: Get raw insurance text for debugging
-    debug_prompt = """
+# Debug-only first pass: get the raw header, insurance and guarantor text
+DEBUG_PROMPT = """
     Look at this facesheet document and find these sections:
     
     1. HEADER/TOP SECTION - Look for any text that contains "MRN:" or "Medical Record Number"
@@ -178,26 +176,8 @@ def extract_facesheet_data(image_paths, debug=False):
     If you cannot find a section, say "SECTION NOT FOUND"
     """
 
-    if debug:
-        try:
-            debug_res = ollama.chat(
-                model=model_name,
-                messages=[
-                    {
-                        'role': 'user',
-                        'content': debug_prompt,
-                        'images': image_paths
-                    }
-                ]
-            )
-            print("🔍 DEBUG - RAW INSURANCE TEXT EXTRACTION:")
-            print(debug_res['message']['content'])
-            print("=" * 60)
-        except Exception as e:
-            print(f"Debug extraction failed: {e}")
-
-    # Main extraction prompt - using what we learned from debug
-    extraction_prompt = """
+# Main extraction prompt - using what we learned from debug
+EXTRACTION_PROMPT = """
     Looking at this facesheet document, please extract ALL available information and format it as JSON.
     
     CRITICAL INSTRUCTIONS:
@@ -223,14 +203,6 @@ def extract_facesheet_data(image_paths, debug=False):
     - Look in the header/top section for "MRN:" followed by a number
     - Extract the number that comes after "MRN:" as medical_record_number
     
-    FOR INSURANCE SECTION - I can see these exact labels in your document:
-    - "ACO Type:" followed by insurance name → insurance_name
-    - "Insurance Information to Patient: SELF" → insured_relation: "SELF"  
-    - "Group Number:" followed by actual number → group_number
-    - "Insurance Company Phone #:" followed by phone → insurance_phone_number
-    - "Mail claim to:" followed by "PO BOX [number]" → insurance_address line_one
-    - "El Paso, TX 79988-1899" (the line after Mail claim to) → insurance_address city, state, zip
-    
     ALSO extract from this alternative insurance format I see:
     - "Insurance:" followed by insurance name → insurance_name
     - "Policy:" followed by policy number → policy_number  
@@ -248,120 +220,269 @@ def extract_facesheet_data(image_paths, debug=False):
     - "City:" value goes in guarantor address city  
     - Look for state and zip in the city line or separate fields
     
-    Format as JSON with this FLATTENED structure:
-    {
-        "gender": "",
-        "date_of_birth": "",
-        "admit_date_time": "",
-        "room": "",
-        "medical_record_number": "extract from MRN: label in header",
-        "account_number": "",
-        "visit_number": "",
-        "location_name": "",
-        "referring_physician": "",
-        "patient_information": {
-            "patient_name": "",
-            "race": "",
-            "ssn": null,
-            "encrypted_ssn": "",
-            "bed": null,
-            "mothers_maiden_name": null,
-            "alias": null,
-            "marital_status": "",
-            "veteran_status": "",
-            "address": {
-                "line_one": "",
-                "line_two": null,
-                "city": "",
-                "state": "",
-                "zip": ""
-            },
-            "home_phone": "",
-            "business_phone": null,
-            "primary_language": "",
-            "county_code": null,
-            "drivers_license_number": null
-        },
-        "guarantor_information": {
-            "name": "extract from Guarantor: label",
-            "phone": "extract from Phone: label in guarantor section",
-            "ssn": null,
-            "encrypted_ssn": null,
-            "address": {
-                "line_one": "extract from Address: label in guarantor section",
-                "line_two": null,
-                "city": "extract from City: label in guarantor section",
-                "state": "extract state from city line or separate field",
-                "zip": "extract zip from city line or separate field"
-            },
-            "contact_name": null,
-            "contact_phone": null,
-            "contact_relation": null,
-            "employer_name": null,
-            "employer_phone": null,
-            "employer_address": null
-        },
-        "insurance_plan_one": {
-            "plan_id": null,
-            "policy_number": null,
-            "group_number": "extract from Group Number: label",
-            "group_name": null,
-            "insurance_name": "extract from ACO Type: label",
-            "insurance_company_id": null,
-            "insurance_phone_number": "extract from Insurance Company Phone #: label",
-            "insurance_address": {
-                "line_one": "extract PO BOX from Mail claim to:",
-                "line_two": null,
-                "city": "extract El Paso from address line",
-                "state": "extract TX from address line", 
-                "zip": "extract 79988-1899 from address line"
-            },
-            "insured_name": null,
-            "insured_dob": null,
-            "insured_address": null,
-            "insured_relation": "extract from Insurance Information to Patient:",
-            "authorization_number": null
-        },
-        "insurance_plan_two": null,
-        "insurance_plan_three": null
-    }
+    Use the FLATTENED JSON structure: header fields at the top level, then
+    patient_information, guarantor_information and insurance_plan_one/two/three (plans in the
+    order they appear on the document, null for plans that aren't there).
     
     Return ONLY the JSON - no explanations or markdown formatting.
     """
 
+# Final user message when several facesheets share one request
+BATCH_PROMPT = """
+    The images above are {count} SEPARATE facesheet documents; each one starts after its own
+    "=== DOC n ===" marker. Apply the instructions to each document on its own and return
+    a JSON array with exactly {count} objects, one per document, in the same order.
+    
+    Return ONLY the JSON array - no explanations or markdown formatting.
+    """
+
+# Validates a whole batch reply in one pass
+FACESHEET_LIST_ADAPTER = TypeAdapter(List[FacesheetObject])
+# JSON schemas for single and batch replies, built once (walking the model graph isn't free)
+FACESHEET_SCHEMA = FacesheetObject.model_json_schema()
+FACESHEET_LIST_SCHEMA = FACESHEET_LIST_ADAPTER.json_schema()
+
+def load_checkpoint():
+    """Load the set of already-processed filenames from the JSON checkpoint plus the run log."""
+    processed = set()
+    if os.path.exists(CHECKPOINT_FILE):
+        with open(CHECKPOINT_FILE, "rb") as f:
+            data = f.read()
+        processed.update(orjson.loads(data) if orjson else json.loads(data))
+    # Entries logged by a run that stopped before compacting
+    if os.path.exists(CHECKPOINT_LOG):
+        with open(CHECKPOINT_LOG, "r") as f:
+            processed.update(line.rstrip("\n") for line in f if line.strip())
+    return processed
+
+def save_checkpoint(processed_set):
+    """Write the processed filenames set back to the JSON checkpoint and drop the run log."""
+    if orjson:
+        with open(CHECKPOINT_FILE, "wb") as f:
+            f.write(orjson.dumps(sorted(processed_set), option=orjson.OPT_INDENT_2))
+    else:
+        with open(CHECKPOINT_FILE, "w") as f:
+            json.dump(sorted(processed_set), f, indent=2)
+    if os.path.exists(CHECKPOINT_LOG):
+        os.remove(CHECKPOINT_LOG)
+
+def get_ollama_client():
+    """Return the shared Ollama client, importing ollama on first use."""
+    global ollama_client
+    if ollama_client is None:
+        import ollama
+        ollama_client = ollama.AsyncClient()
+    return ollama_client
+
+def get_ollama_slots():
+    """Return the shared request semaphore, creating it on first use (inside the running event loop)."""
+    global ollama_slots
+    if ollama_slots is None:
+        ollama_slots = asyncio.Semaphore(OLLAMA_NUM_PARALLEL)
+    return ollama_slots
+
+def cache_key(pdf_path):
+    """
+    Content-addressed cache key for a PDF: SHA-256 over the model name, the extraction prompt
+    and the PDF's bytes, so changing the model or editing the prompt invalidates old entries.
+    """
+    digest = hashlib.sha256()
+    for part in (model_name, EXTRACTION_PROMPT):
+        encoded = part.encode("utf-8")
+        digest.update(len(encoded).to_bytes(8, "big") + encoded)
+    with open(pdf_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def load_cached_extraction(key):
+    """Return the cached extracted data for a key, or None on a miss (or an unreadable entry)."""
     try:
-        # Send all images to Ollama for comprehensive extraction
-        res = ollama.chat(
-            model=model_name,
-            messages=[
-                {
-                    'role': 'user',
-                    'content': extraction_prompt,
-                    'images': image_paths
-                }
+        with open(os.path.join(CACHE_FOLDER, f"{key}.json"), "rb") as f:
+            data = f.read()
+        return (orjson.loads(data) if orjson else json.loads(data))["extracted_data"]
+    except (OSError, ValueError, KeyError):
+        return None
+
+def save_cached_extraction(key, pdf_path, extracted_data):
+    """Store extracted data under its key, with the model and source file for reference."""
+    entry = {
+        "model_name": model_name,
+        "source_filename": os.path.basename(pdf_path),
+        "cached_timestamp": datetime.now().isoformat(),
+        "extracted_data": extracted_data,
+    }
+    cache_path = os.path.join(CACHE_FOLDER, f"{key}.json")
+    # Write to a temp file first so an interrupted run never leaves a half-written entry
+    with open(cache_path + ".tmp", "wb") as f:
+        f.write(orjson.dumps(entry) if orjson else json.dumps(entry).encode("utf-8"))
+    os.replace(cache_path + ".tmp", cache_path)
+
+def select_pages(doc):
+    """
+    Pick the page numbers worth sending to the model, using the text layer (no rendering).
+    Blank pages are dropped; when some pages look like facesheet pages, other pages with text
+    are dropped too. Pages without a text layer (scans) are always kept, since they can't be
+    judged without rendering.
+    """
+    facesheet_pages = []
+    scanned_pages = []
+    text_pages = []
+    for page in doc:
+        text = page.get_text("text").strip()
+        if text:
+            text_pages.append(page.number)
+            if FACESHEET_PAGE_RE.search(text):
+                facesheet_pages.append(page.number)
+        elif page.get_images():
+            scanned_pages.append(page.number)
+
+    if facesheet_pages:
+        selected = sorted(facesheet_pages + scanned_pages)
+    else:
+        selected = sorted(text_pages + scanned_pages)
+    # Never send nothing: fall back to the first page
+    return selected or [0]
+
+def page_dpi(page):
+    """RENDER_DPI, lowered as needed so the page's longest side fits in MAX_IMAGE_PX."""
+    longest_inches = max(page.rect.width, page.rect.height) / 72
+    return max(1, min(RENDER_DPI, int(MAX_IMAGE_PX / longest_inches)))
+
+def convert_pdf_to_images(pdf_path):
+    """
+    Convert the informative pages of a PDF (see select_pages) to in-memory JPEG images.
+    Returns a list of encoded images (bytes), which Ollama accepts as-is.
+    """
+    try:
+        # Render the informative pages in-process with PyMuPDF (no poppler subprocess)
+        colorspace = pymupdf.csGRAY if RENDER_GRAYSCALE else pymupdf.csRGB
+        with pymupdf.open(pdf_path) as doc:
+            total_pages = doc.page_count
+            images = [
+                doc[i].get_pixmap(dpi=page_dpi(doc[i]), colorspace=colorspace).tobytes("jpeg", jpg_quality=JPEG_QUALITY)
+                for i in select_pages(doc)
             ]
-        )
 
-        if debug:
-            print("FACESHEET EXTRACTION RESPONSE:")
-            print(res['message']['content'])
+        print(f"  📄 Converted PDF ({total_pages} pages) → {len(images)} images")
+        return images
+
+    except Exception as e:
+        print(f"  ❌ ERROR converting PDF {pdf_path}: {e}")
+        return []
+
+async def stream_json_reply(**chat_args):
+    """
+    Stream a chat reply and stop reading as soon as the first top-level JSON object or array
+    is complete, so anything the model would write after it is never generated.
+    Returns the reply text up to the end of that value (or all of it if it never closes).
+    """
+    async with get_ollama_slots():
+        stream = await get_ollama_client().chat(stream=True, **chat_args)
+        parts = []
+        depth = 0
+        in_string = escaped = False
+        try:
+            async for chunk in stream:
+                piece = chunk['message']['content']
+                # Track bracket depth outside of strings
+                for i, ch in enumerate(piece):
+                    if in_string:
+                        if escaped:
+                            escaped = False
+                        elif ch == '\\':
+                            escaped = True
+                        elif ch == '"':
+                            in_string = False
+                    elif ch == '"':
+                        in_string = True
+                    elif ch in '{[':
+                        depth += 1
+                    elif ch in '}]':
+                        depth -= 1
+                        if depth == 0:
+                            parts.append(piece[:i + 1])
+                            return ''.join(parts)
+                parts.append(piece)
+        finally:
+            # Closing the stream drops the connection, which stops generation on the server
+            await stream.aclose()
+        return ''.join(parts)
+
+async def extract_facesheet_data(images, debug=False):
+    """
+    Extract comprehensive facesheet data from all page images using Ollama.
+    Returns extracted data as a dictionary with FLATTENED structure.
+    """
+    if debug:
+        print(f"Processing {len(images)} facesheet images")
+        print("=" * 60)
+
+        # First pass: Get raw insurance text for debugging
+        try:
+            async with get_ollama_slots():
+                debug_res = await get_ollama_client().chat(
+                    model=model_name,
+                    messages=[
+                        {
+                            'role': 'user',
+                            'content': DEBUG_PROMPT,
+                            'images': images
+                        }
+                    ],
+                    keep_alive=OLLAMA_KEEP_ALIVE,
+                    options=OLLAMA_OPTIONS
+                )
+            print("🔍 DEBUG - RAW INSURANCE TEXT EXTRACTION:")
+            print(debug_res['message']['content'])
             print("=" * 60)
+        except Exception as e:
+            print(f"Debug extraction failed: {e}")
 
-        response_text = res['message']['content']
-
-        # Extract JSON from response
-        if '```json' in response_text:
-            json_start = response_text.find('```json') + 7
-            json_end = response_text.find('```', json_start)
-            json_text = response_text[json_start:json_end].strip()
-        elif '{' in response_text and '}' in response_text:
-            json_start = response_text.find('{')
-            json_end = response_text.rfind('}') + 1
-            json_text = response_text[json_start:json_end]
-        else:
-            raise ValueError("No JSON found in response")
+    try:
+        # The instructions go first, in a system message, so every request starts with the same
+        # tokens and the server can reuse their cached KV; the page images follow
+        messages = [
+            {
+                'role': 'system',
+                'content': EXTRACTION_PROMPT
+            },
+            {
+                'role': 'user',
+                'content': "Extract the facesheet shown in these images.",
+                'images': images
+            }
+        ]
+        for attempt in range(2):
+            # Send all images to Ollama for comprehensive extraction; the schema constrains
+            # decoding, so the reply is the JSON object itself
+            response_text = await stream_json_reply(
+                model=model_name,
+                messages=messages,
+                format=FACESHEET_SCHEMA,
+                keep_alive=OLLAMA_KEEP_ALIVE,
+                options=OLLAMA_OPTIONS
+            )
+
+            if debug:
+                print("FACESHEET EXTRACTION RESPONSE:")
+                print(response_text)
+                print("=" * 60)
+            try:
+                facesheet = FacesheetObject.model_validate_json(response_text)
+                break
+            except ValidationError as e:
+                if attempt:
+                    raise
+                # Rare (e.g. a reply cut off at the token limit): retry once, showing the
+                # model its reply and what was wrong with it
+                print(f"  ⚠️  Invalid facesheet JSON, retrying: {e.error_count()} errors")
+                messages += [
+                    {'role': 'assistant', 'content': response_text},
+                    {'role': 'user', 'content': f"That reply did not match the schema:\n{e}\nReturn the corrected JSON only."},
+                ]
 
-        extracted_data = json.loads(json_text)
+        extracted_data = facesheet.model_dump()
 
         if debug:
             print("SUCCESSFULLY PARSED FACESHEET JSON:")
@@ -370,7 +491,7 @@ def extract_facesheet_data(image_paths, debug=False):
 
         return extracted_data
 
-    except (json.JSONDecodeError, ValueError) as e:
+    except ValueError as e:
         if debug:
             print(f"JSON PARSING FAILED: {e}")
         else:
@@ -384,61 +505,78 @@ def extract_facesheet_data(image_paths, debug=False):
             print(f"  ❌ ERROR extracting facesheet data: {e}")
         return None
 
-def process_facesheet_pdf(pdf_path, output_folder, debug=False):
+async def extract_facesheet_batch(image_lists, debug=False):
     """
-    Process a single facesheet PDF and save results as JSON with FLATTENED structure.
+    Extract several facesheets in one Ollama request, one "=== DOC n ===" message per document.
+    Returns one extracted-data dictionary (or None) per document, falling back to one request
+    per document when the batch reply doesn't line up with the inputs.
+    """
+    # Debug runs keep one request per document so the raw-text pass matches each reply
+    if debug or len(image_lists) == 1 or sum(len(images) for images in image_lists) > MAX_BATCH_PAGES:
+        return list(await asyncio.gather(*(extract_facesheet_data(images, debug=debug) for images in image_lists)))
+
+    try:
+        # Same shared system prompt as single-document requests, then one message per document
+        messages = [{'role': 'system', 'content': EXTRACTION_PROMPT}]
+        messages += [
+            {
+                'role': 'user',
+                'content': f"=== DOC {doc_number} ===",
+                'images': images
+            }
+            for doc_number, images in enumerate(image_lists, start=1)
+        ]
+        messages.append({
+            'role': 'user',
+            'content': BATCH_PROMPT.format(count=len(image_lists))
+        })
+        response_text = await stream_json_reply(
+            model=model_name,
+            messages=messages,
+            format=FACESHEET_LIST_SCHEMA,
+            keep_alive=OLLAMA_KEEP_ALIVE,
+            options=OLLAMA_OPTIONS
+        )
+        documents = FACESHEET_LIST_ADAPTER.validate_json(response_text)
+        if len(documents) != len(image_lists):
+            raise ValueError(f"expected {len(image_lists)} documents, got {len(documents)}")
+
+        # Handed on as dictionaries, like single-document replies
+        return [document.model_dump() for document in documents]
+
+    except Exception as e:
+        print(f"  ⚠️  Batch extraction failed ({e}), extracting one document at a time")
+        return list(await asyncio.gather(*(extract_facesheet_data(images) for images in image_lists)))
+
+def save_facesheet(extracted_data, pdf_path, output_folder):
+    """
+    Save extracted facesheet data for one PDF as JSON with FLATTENED structure.
     """
     filename = os.path.basename(pdf_path)
     base_name = os.path.splitext(filename)[0]
     output_json_path = os.path.join(output_folder, f"{base_name}.json")
 
     try:
-        # Convert PDF to images
-        print("  📄 Converting PDF to images...")
-        image_paths = convert_pdf_to_images(pdf_path, IMAGES_FOLDER)
-        if not image_paths:
-            print("  ❌ ERROR: Failed to convert PDF to images")
-            return False
-
-        # Extract facesheet data
-        print("  📋 Extracting facesheet data...")
-        extracted_data = extract_facesheet_data(image_paths, debug=debug)
         if extracted_data is None:
-            print("  ❌ ERROR: Failed to extract facesheet data")
+            print(f"  ❌ ERROR: Failed to extract facesheet data from {filename}")
             return False
 
-        # Create FacesheetObject with FLATTENED structure
+        # Create FacesheetObject with FLATTENED structure; one model_validate pass builds
+        # the nested models too
         today = datetime.now()
-        
-        facesheet_obj = FacesheetObject(
+        facesheet_obj = FacesheetObject.model_validate({
+            **extracted_data,
             # Top-level fields (flattened)
-            date=today.strftime("%Y-%m-%d"),
-            display_date=today.strftime("%m/%d/%Y"),
-            gender=extracted_data.get("gender"),
-            date_of_birth=extracted_data.get("date_of_birth"),
-            admit_date_time=extracted_data.get("admit_date_time"),
-            room=extracted_data.get("room"),
-            medical_record_number=extracted_data.get("medical_record_number"),
-            account_number=extracted_data.get("account_number"),
-            visit_number=extracted_data.get("visit_number"),
-            location_name=extracted_data.get("location_name"),
-            referring_physician=extracted_data.get("referring_physician"),
-            
-            # Nested information objects
-            patient_information=PatientInformation(**extracted_data.get("patient_information", {})) if extracted_data.get("patient_information") else None,
-            guarantor_information=GuarantorInformation(**extracted_data.get("guarantor_information", {})) if extracted_data.get("guarantor_information") else None,
-            insurance_plan_one=InsurancePlan(**extracted_data.get("insurance_plan_one", {})) if extracted_data.get("insurance_plan_one") else None,
-            insurance_plan_two=InsurancePlan(**extracted_data.get("insurance_plan_two", {})) if extracted_data.get("insurance_plan_two") else None,
-            insurance_plan_three=InsurancePlan(**extracted_data.get("insurance_plan_three", {})) if extracted_data.get("insurance_plan_three") else None,
-            
+            "date": today.strftime("%Y-%m-%d"),
+            "display_date": today.strftime("%m/%d/%Y"),
             # Processing metadata
-            processed_timestamp=datetime.now().isoformat(),
-            source_filename=filename
-        )
+            "processed_timestamp": today.isoformat(),
+            "source_filename": filename,
+        })
 
         # Save as JSON with proper null handling
         with open(output_json_path, 'w') as f:
-            json.dump(facesheet_obj.model_dump(exclude_none=False), f, indent=2, default=str)
+            f.write(facesheet_obj.model_dump_json(indent=2))
 
         print(f"  ✅ SUCCESS: Saved to {output_json_path}")
         return True
@@ -447,22 +585,93 @@ def process_facesheet_pdf(pdf_path, output_folder, debug=False):
         print(f"  ❌ ERROR processing {filename}: {e}")
         return False
 
+async def process_facesheet_group(pdf_paths, output_folder, render_pool, semaphore, debug=False):
+    """
+    Process a group of facesheet PDFs with one model request and save each result as JSON.
+    PDFs already in the cache skip rendering and the model entirely. The rest are rendered in
+    render_pool before taking an inference slot from semaphore, so rendering overlaps the other
+    groups' model calls. Returns one success flag per PDF.
+    """
+    results = [False] * len(pdf_paths)
+
+    # Hash the PDFs off the event loop; a PDF that can't be hashed is just not cached
+    keys = await asyncio.gather(
+        *(asyncio.to_thread(cache_key, pdf_path) for pdf_path in pdf_paths),
+        return_exceptions=True,
+    )
+    keys = [None if isinstance(key, Exception) else key for key in keys]
+
+    pending = []
+    for i, (pdf_path, key) in enumerate(zip(pdf_paths, keys)):
+        cached = load_cached_extraction(key) if key else None
+        if cached is None:
+            pending.append(i)
+        else:
+            print(f"  💾 Cache hit: {os.path.basename(pdf_path)}")
+            results[i] = save_facesheet(cached, pdf_path, output_folder)
+
+    if not pending:
+        return results
+
+    # Convert PDFs to images
+    print(f"  📄 Converting {len(pending)} PDFs to images...")
+    loop = asyncio.get_running_loop()
+    rendered = await asyncio.gather(
+        *(loop.run_in_executor(render_pool, convert_pdf_to_images, pdf_paths[i]) for i in pending)
+    )
+
+    ready = []
+    images_by_pdf = {}
+    for i, images in zip(pending, rendered):
+        if images:
+            ready.append(i)
+            images_by_pdf[i] = images
+        else:
+            print(f"  ❌ ERROR: Failed to convert {os.path.basename(pdf_paths[i])} to images")
+
+    if ready:
+        # Extract facesheet data
+        print(f"  📋 Extracting facesheet data from {len(ready)} PDFs...")
+        async with semaphore:
+            extracted = await extract_facesheet_batch([images_by_pdf[i] for i in ready], debug=debug)
+        for i, extracted_data in zip(ready, extracted):
+            if extracted_data is not None and keys[i]:
+                try:
+                    save_cached_extraction(keys[i], pdf_paths[i], extracted_data)
+                except OSError as e:
+                    print(f"  ⚠️  Could not cache {os.path.basename(pdf_paths[i])}: {e}")
+            results[i] = save_facesheet(extracted_data, pdf_paths[i], output_folder)
+
+    return results
+
 def generate_schema():
-    """Generate and save the JSON schema for the FacesheetObject model."""
-    schema = FacesheetObject.model_json_schema()
+    """Generate and save the JSON schema for the FacesheetObject model (skipped when unchanged)."""
     schema_path = os.path.join(OUTPUT_FOLDER, "facesheet_schema.json")
+    if orjson:
+        schema_bytes = orjson.dumps(FACESHEET_SCHEMA, option=orjson.OPT_INDENT_2)
+    else:
+        schema_bytes = json.dumps(FACESHEET_SCHEMA, indent=2).encode("utf-8")
     
-    with open(schema_path, 'w') as f:
-        json.dump(schema, f, indent=2)
+    # The models rarely change between runs; leave an identical file (and its mtime) alone
+    try:
+        with open(schema_path, 'rb') as f:
+            if f.read() == schema_bytes:
+                print(f"📋 JSON Schema up to date: {schema_path}")
+                return schema_path
+    except OSError:
+        pass
+    
+    with open(schema_path, 'wb') as f:
+        f.write(schema_bytes)
     
     print(f"📋 JSON Schema saved to: {schema_path}")
     return schema_path
 
-def main():
-    # Ensure output folders exist
-    for folder in [OUTPUT_FOLDER, IMAGES_FOLDER]:
-        if not os.path.exists(folder):
-            os.makedirs(folder)
+async def main(debug=False):
+    # Ensure output and cache folders exist
+    if not os.path.exists(OUTPUT_FOLDER):
+        os.makedirs(OUTPUT_FOLDER)
+    os.makedirs(CACHE_FOLDER, exist_ok=True)
 
     # Generate and save the schema
     generate_schema()
@@ -476,14 +685,16 @@ def main():
         print(f"Please create the folder and add your facesheet PDFs there.")
         return
 
-    # Fetch list of all PDFs in source folder
-    all_pdfs = [
-        fname for fname in os.listdir(SOURCE_FOLDER)
-        if fname.lower().endswith(".pdf")
-    ]
-
-    # Filter out already-processed
-    to_process = [f for f in all_pdfs if f not in processed]
+    # Fetch unprocessed PDFs in one pass over the source folder; scandir entries carry the
+    # file type, so no per-file stat is needed
+    all_pdfs = []
+    to_process = []
+    with os.scandir(SOURCE_FOLDER) as entries:
+        for entry in entries:
+            if entry.name.lower().endswith(".pdf") and entry.is_file():
+                all_pdfs.append(entry.name)
+                if entry.name not in processed:
+                    to_process.append(entry.name)
 
     if not to_process:
         if not all_pdfs:
@@ -494,20 +705,38 @@ def main():
         return
 
     print(f"Found {len(all_pdfs)} total PDFs, {len(to_process)} to process")
+    print(f"Processing up to {OLLAMA_NUM_PARALLEL} groups of {FACESHEET_BATCH_SIZE} PDFs concurrently")
+    if "OLLAMA_NUM_PARALLEL" not in os.environ:
+        print(f"⚠️  OLLAMA_NUM_PARALLEL not set; assuming the server handles {OLLAMA_NUM_PARALLEL} requests at once")
+        print("   (set it to the same value for both 'ollama serve' and this script)")
     print("=" * 50)
 
     # Track counts and time
     successful_count = 0
     error_count = 0
-    start_time = datetime.now()
-
-    for idx, filename in enumerate(to_process, start=1):
-        print(f"[{idx}/{len(to_process)}] Processing: {filename}")
-        pdf_path = os.path.join(SOURCE_FOLDER, filename)
-
-        try:
-            success = process_facesheet_pdf(pdf_path, OUTPUT_FOLDER, debug=True)  # Keep debug enabled for troubleshooting
-            
+    start_time = time.perf_counter()
+
+    # PDFs are scheduled in groups of FACESHEET_BATCH_SIZE; the semaphore caps how many groups
+    # are in inference, prefetch how many are rendered or waiting. Renders run in a process pool
+    # (PyMuPDF is not thread-safe) and overlap with the other groups' inference
+    semaphore = asyncio.Semaphore(OLLAMA_NUM_PARALLEL)
+    prefetch = asyncio.Semaphore(OLLAMA_NUM_PARALLEL + PREFETCH_DEPTH)
+    render_pool = ProcessPoolExecutor(max_workers=RENDER_WORKERS)
+
+    async def process_group(first_idx, filenames):
+        nonlocal successful_count, error_count, checkpoint_log, logged_count
+        async with prefetch:
+            for idx, filename in enumerate(filenames, start=first_idx):
+                print(f"[{idx}/{len(to_process)}] Processing: {filename}")
+            pdf_paths = [os.path.join(SOURCE_FOLDER, filename) for filename in filenames]
+
+            try:
+                outcomes = await process_facesheet_group(pdf_paths, OUTPUT_FOLDER, render_pool, semaphore, debug=debug)
+            except Exception as e:
+                print(f"  ❌ UNEXPECTED ERROR processing {', '.join(filenames)}: {e}")
+                outcomes = [False] * len(filenames)
+
+        for filename, success in zip(filenames, outcomes):
             if success:
                 successful_count += 1
             else:
@@ -515,25 +744,40 @@ def main():
 
             # Mark as processed regardless of success (to avoid infinite retries)
             processed.add(filename)
-            save_checkpoint(processed)
+            checkpoint_log.write(filename + "\n")
+            logged_count += 1
 
             # Progress update every 5 files (lower for testing)
-            if successful_count % 5 == 0 and successful_count > 0:
-                elapsed = datetime.now() - start_time
-                avg_time = elapsed.total_seconds() / (successful_count + error_count)
-                remaining = len(to_process) - idx
+            if success and successful_count % 5 == 0:
+                done = successful_count + error_count
+                avg_time = (time.perf_counter() - start_time) / done
+                remaining = len(to_process) - done
                 est_remaining = avg_time * remaining / 60  # minutes
                 print(f"  ⏱️  Progress: {successful_count}/{len(to_process)} | Est. remaining: {est_remaining:.1f} min")
+        checkpoint_log.flush()
 
-        except Exception as e:
-            print(f"  ❌ UNEXPECTED ERROR processing {filename}: {e}")
-            error_count += 1
-            processed.add(filename)
+        # Periodic compaction: rewrite the JSON checkpoint and start a fresh log
+        if logged_count >= CHECKPOINT_COMPACT_EVERY:
+            checkpoint_log.close()
             save_checkpoint(processed)
-            continue
+            checkpoint_log = open(CHECKPOINT_LOG, "a")
+            logged_count = 0
+
+    # One line per finished PDF instead of rewriting the whole JSON checkpoint each time
+    checkpoint_log = open(CHECKPOINT_LOG, "a")
+    logged_count = 0
+    try:
+        await asyncio.gather(*(
+            process_group(i + 1, to_process[i:i + FACESHEET_BATCH_SIZE])
+            for i in range(0, len(to_process), FACESHEET_BATCH_SIZE)
+        ))
+    finally:
+        render_pool.shutdown(cancel_futures=True)
+        checkpoint_log.close()
+        save_checkpoint(processed)
 
     # Final summary
-    total_time = datetime.now() - start_time
+    total_time = timedelta(seconds=time.perf_counter() - start_time)
     print("\n" + "="*50)
     print("FACESHEET PROCESSING COMPLETE")
     print("="*50)
@@ -550,26 +794,31 @@ if __name__ == "__main__":
     print(f"Source folder: {SOURCE_FOLDER}")
     print(f"Checkpoint file: {CHECKPOINT_FILE}")
     print(f"Output folder: {OUTPUT_FOLDER}")
-    print(f"Images temporary folder: {IMAGES_FOLDER}")
     print("🔧 UPDATES: Flattened structure + single account_number + SSN handling")
     print("=" * 60)
     
     # Add command line options
-    import sys
+    import argparse
+    
+    parser = argparse.ArgumentParser(description="Extract facesheet data from PDFs into JSON files")
+    parser.add_argument("--schema-only", action="store_true", help="only generate the JSON schema")
+    parser.add_argument("--view-schema", action="store_true", help="print the JSON schema")
+    parser.add_argument("--debug", action="store_true",
+                        help="print model responses and run an extra raw-text pass per PDF (doubles model time)")
+    args = parser.parse_args()
     
-    if len(sys.argv) > 1 and sys.argv[1] == "--schema-only":
+    if args.schema_only:
         # Just generate schema and exit
         if not os.path.exists(OUTPUT_FOLDER):
             os.makedirs(OUTPUT_FOLDER)
         schema_path = generate_schema()
         print(f"Schema generated at: {schema_path}")
         print("Use 'python script.py --view-schema' to view the schema")
-    elif len(sys.argv) > 1 and sys.argv[1] == "--view-schema":
+    elif args.view_schema:
         # Display the schema
-        schema = FacesheetObject.model_json_schema()
         print("FACESHEET JSON SCHEMA:")
         print("=" * 60)
-        print(json.dumps(schema, indent=2))
+        print(json.dumps(FACESHEET_SCHEMA, indent=2))
     else:
         # Normal processing
-        main()
\ No newline at end of file
+        asyncio.run(main(debug=args.debug))
\ No newline at end of file
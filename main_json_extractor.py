@@ -1,20 +1,60 @@
 import os
+import io
 import json
+import asyncio
 import ollama
 import re
+import hashlib
 from datetime import datetime
 from pdf2image import convert_from_path, pdfinfo_from_path
-from PIL import Image
+from pydantic import BaseModel, Field, ValidationError
 
 # Path to the folder containing all PDFs
 SOURCE_FOLDER = "/home/shared/usacs_documents"
 # Folder where JSON results are saved
 JSON_OUTPUT_FOLDER = "json_output"
-# Folder where temporary images will be written
-IMAGES_FOLDER = "images"
+# Model replies cached by content hash, so re-runs and duplicate PDFs skip the model
+CACHE_FOLDER = "json_cache"
+# PDFs rendered ahead of the one being extracted, so the model never waits on Poppler
+PREFETCH_DEPTH = 2
 # Name of the checkpoint file in the working directory
 CHECKPOINT_FILE = "processed_files_json.json"
-MODEL_NAME = "gemma3:27b"
+# Small quantized model for the narrow, high-volume tasks: page OCR and the signature date
+MODEL_FAST = "gemma3:4b-it-q4_K_M"
+# Full model for the structured header JSON, where field accuracy matters most.
+# The server must keep both resident: start it with OLLAMA_MAX_LOADED_MODELS=2. Server settings are
+# per script: main.py and main_facesheet_extraction.py use a single model and recommend =1
+MODEL_STRUCTURED = "gemma3:27b"
+# Render resolution for page 1, whose header crop feeds the structured extraction and needs sharp small print
+HEADER_DPI = 200
+# Render resolution for text extraction; the model reads body text fine at 120 DPI,
+# with ~36% of the pixels of a 200 DPI page
+PAGE_DPI = 120
+# JPEG quality for images sent to Ollama (kept in memory, never written to disk)
+JPEG_QUALITY = 85
+# Page OCR requests in flight at once; match the server's OLLAMA_NUM_PARALLEL (start it with
+# OLLAMA_NUM_PARALLEL=4) so the pages of a document are decoded side by side instead of queued
+OLLAMA_NUM_PARALLEL = int(os.environ.get("OLLAMA_NUM_PARALLEL", 4))
+# Delimiter the model writes between pages when several pages are OCR'd in one request
+PAGE_SEPARATOR = "<<<PAGE>>>"
+# Most page images sent in one OCR request; longer documents are split into several requests
+# so the combined images and reply stay inside the model's context window
+OCR_BATCH_PAGES = 8
+# Model answers that mean a field was not found (compared lowercased, after stripping)
+NA_SENTINELS = frozenset({'n/a', 'na', 'not available', 'not visible', '', 'unclear'})
+# Signature dates in model responses (MM/DD/YYYY, also M/D/YYYY)
+DATE_RE = re.compile(r'(\d{1,2}/\d{1,2}/\d{4})')
+# Everything except digits and slashes, stripped when salvaging a malformed date
+NON_DATE_CHARS_RE = re.compile(r'[^\d/]')
+# Signature line in OCR'd page text; when it's found the signature date needs no vision call
+SIGNED_ON_RE = re.compile(r'ELECTRONICALLY SIGNED ON\s+(\d{1,2}/\d{1,2}/\d{4})', re.IGNORECASE)
+# Keep the model resident in VRAM for the whole run (-1 = never unload); avoids reload stalls
+# when a slow render leaves the server idle past its default 5 minute timeout
+OLLAMA_KEEP_ALIVE = -1
+# One client (one pooled, keep-alive HTTP connection set) shared by every request in the run
+ollama_client = ollama.AsyncClient()
+# Caps requests in flight across all PDFs at OLLAMA_NUM_PARALLEL; created inside the event loop
+ollama_slots = None
 
 def load_checkpoint():
     """Load the set of already-processed filenames from JSON checkpoint."""
@@ -29,43 +69,175 @@ def save_checkpoint(processed_set):
     with open(CHECKPOINT_FILE, "w") as f:
         json.dump(sorted(processed_set), f, indent=2)
 
-def crop_image_to_header(image_path, crop_fraction=0.33):
-    """Crop image to top portion (header section only)."""
+# Header fields the model must return; passed to Ollama as format= so the reply is always this JSON
+# (the descriptions are also the prompt's JSON template, so each field is defined in one place)
+class HeaderSchema(BaseModel):
+    patient_name: str = Field(description="patient's full name")
+    date_of_birth: str = Field(description="DOB in MM/DD/YYYY format")
+    medical_record_number: str = Field(description="Medical Record Number (MRN) if available")
+    gender: str = Field(description="Male/Female/Other")
+    admit_date: str = Field(description="first date from Admit/Disch field (before the / if two dates present)")
+    discharge_date: str = Field(description="second date from Admit/Disch field (after the / if two dates present, otherwise N/A)")
+    attending_physician: str = Field(description="attending doctor's name")
+    location: str = Field(description="patient location including LD: prefix if present")
+    facility_name: str = Field(description="facility name in bold text located in the top right area above the address")
+    facility_address: str = Field(description="facility street address")
+    facility_city: str = Field(description="facility city")
+    facility_state: str = Field(description="facility state")
+    facility_zip: str = Field(description="facility zip code")
+    document_name: str = Field(description="type of document")
+    document_status: str = Field(description="document status (look for Verified, Auth, etc.)")
+    performed_by: str = Field(description="who performed/created the document")
+    authenticated_by: str = Field(description="who authenticated the document with timestamp")
+
+HEADER_SCHEMA = HeaderSchema.model_json_schema()
+
+def is_valid_header(response_text):
+    """True if a header reply parses as HeaderSchema (only such replies are cached)."""
     try:
-        with Image.open(image_path) as img:
-            width, height = img.size
-            crop_height = int(height * crop_fraction)
-            crop_box = (0, 0, width, crop_height)
-            cropped_img = img.crop(crop_box)
-            cropped_img.save(image_path, "PNG")
-            print(f"  Cropped header image from {width}x{height} to {width}x{crop_height} (top {int(crop_fraction*100)}%)")
-            return image_path
+        HeaderSchema.model_validate_json(response_text)
+        return True
+    except ValidationError:
+        return False
+
+# Header field names in output order
+HEADER_FIELDS = tuple(HeaderSchema.model_fields)
+# JSON template shown to the model, one "field": "description" line per header field
+HEADER_TEMPLATE = "{\n" + ",\n".join(
+    f'        "{name}": "{field.description}"' for name, field in HeaderSchema.model_fields.items()
+) + "\n    }"
+# Header extraction prompt (the header crop is sent with it, constrained to HEADER_SCHEMA)
+HEADER_PROMPT = f"""
+    Looking at this medical document image, please extract the following information and format it as JSON.
+
+    Pay special attention to:
+    - Patient name: appears after "Patient:"
+    - MRN: appears after "MRN:"
+    - DOB: appears after "DOB/Age/Sex:" in MM/DD/YYYY format
+    - Gender: appears after the age in the DOB/Age/Sex line
+    - Admit/Disch dates: appears after "Admit/Disch.:" (this could be admission or discharge date)
+    - Attending physician: appears after "Attending:"
+    - Location: appears as "LD:" followed by location code (include the "LD:" prefix)
+    - Facility name: Use the specific medical center name (White Oak Medical Center), not the parent organization
+    - Document name: appears after "DOCUMENT NAME:" or can be inferred
+    - Document status: appears after "DOCUMENT STATUS:" or look for "Verified"/"Auth" status
+    - Authentication: appears in "AUTHENTICATED BY:" section
+
+    {HEADER_TEMPLATE}
+
+    If any field is not clearly visible, use "N/A". Only extract what you can clearly read.
+    """
+
+def cache_key(model, messages, format=None):
+    """
+    Content-addressed key for one model request: SHA-256 over the model name, the output
+    schema and each message's role, text and image bytes, every field length-prefixed so
+    one can't run into the next.
+    """
+    digest = hashlib.sha256()
+    parts = [model.encode("utf-8"), json.dumps(format, sort_keys=True).encode("utf-8")]
+    for message in messages:
+        parts += [message['role'].encode("utf-8"), message['content'].encode("utf-8")]
+        parts += message.get('images', [])
+    for part in parts:
+        digest.update(len(part).to_bytes(8, "big") + part)
+    return digest.hexdigest()
+
+def load_cached_response(key):
+    """Return the cached model reply for a key, or None on a miss (or an unreadable entry)."""
+    try:
+        with open(os.path.join(CACHE_FOLDER, key[:2], f"{key}.json"), "r", encoding="utf-8") as f:
+            return json.load(f)["response"]
+    except (OSError, ValueError, KeyError):
+        return None
+
+def save_cached_response(key, model, response):
+    """Store a model reply under its key."""
+    cache_dir = os.path.join(CACHE_FOLDER, key[:2])
+    os.makedirs(cache_dir, exist_ok=True)
+    cache_path = os.path.join(cache_dir, f"{key}.json")
+    entry = {
+        "model_name": model,
+        "cached_timestamp": datetime.now().isoformat(),
+        "response": response,
+    }
+    # Write to a temp file first so an interrupted run never leaves a half-written entry
+    with open(cache_path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(entry, f, ensure_ascii=False)
+    os.replace(cache_path + ".tmp", cache_path)
+
+def get_ollama_slots():
+    """Return the shared request semaphore, creating it on first use (inside the running event loop)."""
+    global ollama_slots
+    if ollama_slots is None:
+        ollama_slots = asyncio.Semaphore(OLLAMA_NUM_PARALLEL)
+    return ollama_slots
+
+async def chat_cached(model, prompt, images, format=None, followup=(), accept=None):
+    """
+    Send a prompt and images to a model and return the reply text, reusing a cached reply
+    when the input is identical. followup holds any later turns (e.g. a retry with feedback);
+    format is an optional JSON schema the reply is constrained to. accept is an optional check
+    on the reply text: replies it rejects are returned but not cached, so a later run asks again.
+    """
+    messages = [
+        {
+            'role': 'user',
+            'content': prompt,
+            'images': images
+        },
+        *followup
+    ]
+    key = cache_key(model, messages, format)
+    response = load_cached_response(key)
+    if response is None:
+        async with get_ollama_slots():
+            res = await ollama_client.chat(
+                model=model,
+                keep_alive=OLLAMA_KEEP_ALIVE,
+                messages=messages,
+                format=format
+            )
+        response = res['message']['content']
+        if accept is None or accept(response):
+            save_cached_response(key, model, response)
+    return response
+
+def crop_image_to_header(img, crop_fraction=0.33):
+    """Crop a page image (PIL) to its top portion (header section only); the page itself is left as-is."""
+    try:
+        width, height = img.size
+        crop_height = int(height * crop_fraction)
+        crop_box = (0, 0, width, crop_height)
+        cropped_img = img.crop(crop_box)
+        print(f"  Cropped header image from {width}x{height} to {width}x{crop_height} (top {int(crop_fraction*100)}%)")
+        return cropped_img
     except Exception as e:
-        print(f"  Warning: Failed to crop header image {image_path}: {e}")
-        return image_path
+        print(f"  Warning: Failed to crop header image: {e}")
+        return img
+
+def image_to_bytes(img):
+    """Encode a PIL image as JPEG bytes, which Ollama accepts directly (no temporary file)."""
+    buf = io.BytesIO()
+    img.convert("RGB").save(buf, "JPEG", quality=JPEG_QUALITY)
+    return buf.getvalue()
 
-def extract_text_from_image(image_path, debug=False):
+async def extract_text_from_image(image, debug=False):
     """Extract all text from a single page image via Ollama."""
     if debug:
-        print(f"Extracting text from: {image_path}")
+        print(f"Extracting text from page image ({len(image)} bytes)")
 
     try:
-        res = ollama.chat(
-            model=MODEL_NAME,
-            messages=[
-                {
-                    'role': 'user',
-                    'content': (
-                        'Please extract all text from this image. '
-                        'Return only the text content, maintaining line breaks and formatting where possible. '
-                        'Do not add any commentary or descriptions.'
-                    ),
-                    'images': [image_path]
-                }
-            ]
+        response_text = await chat_cached(
+            MODEL_FAST,
+            'Please extract all text from this image. '
+            'Return only the text content, maintaining line breaks and formatting where possible. '
+            'Do not add any commentary or descriptions.',
+            [image],
+            accept=bool
         )
 
-        extracted_text = res['message']['content'].strip()
+        extracted_text = response_text.strip()
         if debug:
             print(f"EXTRACTED TEXT ({len(extracted_text)} chars):")
             print(extracted_text[:200] + "..." if len(extracted_text) > 200 else extracted_text)
@@ -74,23 +246,77 @@ def extract_text_from_image(image_path, debug=False):
 
     except Exception as e:
         if debug:
-            print(f"ERROR extracting text from {image_path}: {e}")
+            print(f"ERROR extracting text from page image: {e}")
         else:
-            print(f"  ❌ ERROR extracting text from {image_path}: {e}")
+            print(f"  ❌ ERROR extracting text from page image: {e}")
         return "EXTRACTION_FAILED"
 
-def extract_full_document_text(image_paths, debug=False):
-    """Extract text from all pages and concatenate with page separators."""
+def split_page_texts(response_text, page_count):
+    """Split a multi-page OCR reply on PAGE_SEPARATOR; None if it doesn't give exactly page_count pages."""
+    page_texts = [text.strip() for text in response_text.split(PAGE_SEPARATOR)]
+    # Tolerate a separator after the last page
+    if len(page_texts) == page_count + 1 and not page_texts[-1]:
+        page_texts.pop()
+    return page_texts if len(page_texts) == page_count else None
+
+async def extract_text_from_images(images, debug=False):
+    """
+    Extract the text of several page images in one Ollama request.
+    Returns one text per image, or None if the reply can't be split back into pages.
+    """
+    try:
+        response_text = await chat_cached(
+            MODEL_FAST,
+            f'Please extract all text from each of these {len(images)} page images, in order. '
+            'Return only the text content, maintaining line breaks and formatting where possible. '
+            'Do not add any commentary or descriptions. '
+            f'Separate the pages with a line containing exactly "{PAGE_SEPARATOR}".',
+            images,
+            accept=lambda text: split_page_texts(text, len(images)) is not None
+        )
+    except Exception as e:
+        print(f"  ❌ ERROR extracting text from {len(images)} pages: {e}")
+        return None
+
+    page_texts = split_page_texts(response_text, len(images))
+    if page_texts is None and debug:
+        print(f"BATCH REPLY DID NOT SPLIT INTO {len(images)} PAGES")
+    return page_texts
+
+async def extract_full_document_text(images, debug=False):
+    """Extract text from all pages and concatenate in page order with separators."""
     if debug:
         print("Extracting full document text from all pages...")
 
+    # Requests are capped at OLLAMA_NUM_PARALLEL in chat_cached, so every page can be dispatched at once
+    async def extract_page(page_num, image):
+        print(f"  📄 Processing page {page_num}...")
+        return await extract_text_from_image(image, debug=debug)
+
+    async def extract_chunk(first_page, chunk_images):
+        # Several pages share one request; fall back to one request per page if the reply
+        # doesn't split into the right number of pages
+        if len(chunk_images) > 1:
+            print(f"  📄 Processing pages {first_page}-{first_page + len(chunk_images) - 1}...")
+            page_texts = await extract_text_from_images(chunk_images, debug=debug)
+            if page_texts is not None:
+                return page_texts
+            print(f"  ⚠️  Page split mismatch, retrying pages {first_page}-{first_page + len(chunk_images) - 1} one at a time")
+        return await asyncio.gather(
+            *(extract_page(page_num, image) for page_num, image in enumerate(chunk_images, first_page))
+        )
+
+    # gather returns results in argument order, so the chunks concatenate back into page order
+    chunk_texts = await asyncio.gather(
+        *(extract_chunk(start + 1, images[start:start + OCR_BATCH_PAGES])
+          for start in range(0, len(images), OCR_BATCH_PAGES))
+    )
+    page_texts = [page_text for chunk in chunk_texts for page_text in chunk]
+
     full_text_parts = []
     failed_pages = []
 
-    for page_num, image_path in enumerate(image_paths, 1):
-        print(f"  📄 Processing page {page_num}...")
-        page_text = extract_text_from_image(image_path, debug=debug)
-        
+    for page_num, page_text in enumerate(page_texts, 1):
         if page_text == "EXTRACTION_FAILED":
             failed_pages.append(page_num)
             continue
@@ -105,7 +331,7 @@ def extract_full_document_text(image_paths, debug=False):
 
     if failed_pages:
         print(f"  ❌ Failed to extract text from pages: {failed_pages}")
-        if len(failed_pages) == len(image_paths):
+        if len(failed_pages) == len(images):
             return "EXTRACTION_FAILED"
 
     full_text = "".join(full_text_parts)
@@ -117,50 +343,44 @@ def extract_full_document_text(image_paths, debug=False):
 
     return full_text
 
-def extract_electronic_signature_date(image_path, debug=False):
+def find_signature_date(full_text, page_count):
+    """Find the electronic signature date in the last page's already-extracted text; None if it isn't there."""
+    last_page_header = f"--- Page {page_count} ---\n"
+    if last_page_header not in full_text:
+        return None
+    match = SIGNED_ON_RE.search(full_text, full_text.rindex(last_page_header))
+    return match.group(1) if match else None
+
+async def extract_electronic_signature_date(image, debug=False):
     """Extract electronic signature date from last-page image via Ollama."""
     if debug:
-        print(f"Extracting signature date from: {image_path}")
+        print(f"Extracting signature date from last-page image ({len(image)} bytes)")
 
     try:
-        res = ollama.chat(
-            model=MODEL_NAME,
-            messages=[
-                {
-                    'role': 'user',
-                    'content': (
-                        'Look at this image and find any text that says '
-                        '"ELECTRONICALLY SIGNED ON" followed by a date and time. '
-                        'Extract just the date portion in MM/DD/YYYY format. '
-                        'If you cannot find this text, respond with "N/A".'
-                    ),
-                    'images': [image_path]
-                }
-            ]
+        response_text = await chat_cached(
+            MODEL_FAST,
+            'Look at this image and find any text that says '
+            '"ELECTRONICALLY SIGNED ON" followed by a date and time. '
+            'Extract just the date portion in MM/DD/YYYY format. '
+            'If you cannot find this text, respond with "N/A".',
+            [image],
+            accept=bool
         )
-
-        response_text = res['message']['content'].strip()
+        response_text = response_text.strip()
         if debug:
             print("SIGNATURE EXTRACTION RESPONSE:")
             print(response_text)
 
-        # Regex patterns for dates
-        date_patterns = [
-            r'(\d{2}/\d{2}/\d{4})',      # MM/DD/YYYY
-            r'(\d{1,2}/\d{1,2}/\d{4})',  # M/D/YYYY or variations
-        ]
-
-        for pattern in date_patterns:
-            matches = re.findall(pattern, response_text)
-            if matches:
-                extracted_date = matches[0]
-                if debug:
-                    print(f"EXTRACTED DATE: {extracted_date}")
-                return extracted_date
+        match = DATE_RE.search(response_text)
+        if match:
+            extracted_date = match.group(1)
+            if debug:
+                print(f"EXTRACTED DATE: {extracted_date}")
+            return extracted_date
 
         # Fallback: if response contains '/', try to clean up
         if 'N/A' not in response_text and '/' in response_text:
-            cleaned = re.sub(r'[^\d/]', '', response_text)
+            cleaned = NON_DATE_CHARS_RE.sub('', response_text)
             if len(cleaned) >= 8 and cleaned.count('/') == 2:
                 return cleaned
 
@@ -177,13 +397,12 @@ def extract_electronic_signature_date(image_path, debug=False):
 
 def validate_extracted_data(data):
     """Clean up and validate fields returned from Ollama extraction."""
-    validated = data.copy()
-
-    for key, value in validated.items():
-        if isinstance(value, str):
-            validated[key] = value.strip()
-            if value.lower() in ['n/a', 'na', 'not available', 'not visible', '', 'unclear']:
-                validated[key] = "N/A"
+    # Strip strings and map "not there" answers to N/A in one pass (builds the new dict directly)
+    validated = {
+        key: ("N/A" if (stripped := value.strip()).lower() in NA_SENTINELS else stripped)
+        if isinstance(value, str) else value
+        for key, value in data.items()
+    }
 
     # Document status inference
     if validated.get('document_status') == "N/A":
@@ -209,105 +428,34 @@ def validate_extracted_data(data):
 
     return validated
 
-def ollama_process_image(image_path, debug=False):
-    """Process first-page image: header cropping + two-step Ollama extraction."""
+async def ollama_process_image(image, debug=False):
+    """Process the cropped first-page header image with a schema-constrained Ollama extraction."""
     if debug:
-        print(f"Processing header image: {image_path}")
-
-    # Crop header portion
-    image_path = crop_image_to_header(image_path, crop_fraction=0.33)
-
-    # Step 1: Raw description prompt
-    res = ollama.chat(
-        model=MODEL_NAME,
-        messages=[
-            {
-                'role': 'user',
-                'content': (
-                    'What do you see in this image? Describe all text you can read, '
-                    'including any medical document information, patient details, dates, '
-                    'and facility information.'
-                ),
-                'images': [image_path]
-            }
-        ]
-    )
-
-    if debug:
-        print("RAW MODEL RESPONSE:")
-        print(res['message']['content'])
-
-    # Step 2: Structured JSON extraction
-    structured_prompt = f"""
-    Looking at this medical document image, please extract the following information and format it as JSON.
-
-    Pay special attention to:
-    - Patient name: appears after "Patient:"
-    - MRN: appears after "MRN:"
-    - DOB: appears after "DOB/Age/Sex:" in MM/DD/YYYY format
-    - Gender: appears after the age in the DOB/Age/Sex line
-    - Admit/Disch dates: appears after "Admit/Disch.:" (this could be admission or discharge date)
-    - Attending physician: appears after "Attending:"
-    - Location: appears as "LD:" followed by location code (include the "LD:" prefix)
-    - Facility name: Use the specific medical center name (White Oak Medical Center), not the parent organization
-    - Document name: appears after "DOCUMENT NAME:" or can be inferred
-    - Document status: appears after "DOCUMENT STATUS:" or look for "Verified"/"Auth" status
-    - Authentication: appears in "AUTHENTICATED BY:" section
-
-    {{
-        "patient_name": "patient's full name",
-        "date_of_birth": "DOB in MM/DD/YYYY format",
-        "medical_record_number": "Medical Record Number (MRN) if available",
-        "gender": "Male/Female/Other",
-        "admit_date": "first date from Admit/Disch field (before the / if two dates present)",
-        "discharge_date": "second date from Admit/Disch field (after the / if two dates present, otherwise N/A)",
-        "attending_physician": "attending doctor's name",
-        "location": "patient location including LD: prefix if present",
-        "facility_name": "facility name in bold text located in the top right area above the address",
-        "facility_address": "facility street address",
-        "facility_city": "facility city",
-        "facility_state": "facility state",
-        "facility_zip": "facility zip code",
-        "document_name": "type of document",
-        "document_status": "document status (look for Verified, Auth, etc.)",
-        "performed_by": "who performed/created the document",
-        "authenticated_by": "who authenticated the document with timestamp"
-    }}
-
-    If any field is not clearly visible, use "N/A". Only extract what you can clearly read.
-    """
+        print(f"Processing header image ({len(image)} bytes)")
 
     try:
-        structured_res = ollama.chat(
-            model=MODEL_NAME,
-            messages=[
-                {
-                    'role': 'user',
-                    'content': structured_prompt,
-                    'images': [image_path]
-                }
-            ]
-        )
-
-        if debug:
-            print("STRUCTURED EXTRACTION ATTEMPT:")
-            print(structured_res['message']['content'])
-
-        response_text = structured_res['message']['content']
-
-        # Extract the JSON block
-        if '```json' in response_text:
-            json_start = response_text.find('```json') + 7
-            json_end = response_text.find('```', json_start)
-            json_text = response_text[json_start:json_end].strip()
-        elif '{' in response_text and '}' in response_text:
-            json_start = response_text.find('{')
-            json_end = response_text.rfind('}') + 1
-            json_text = response_text[json_start:json_end]
-        else:
-            raise ValueError("No JSON found in response")
-
-        extracted_data = json.loads(json_text)
+        followup = []
+        for attempt in range(2):
+            # The schema constrains decoding, so the reply is the JSON object itself
+            response_text = await chat_cached(MODEL_STRUCTURED, HEADER_PROMPT, [image], format=HEADER_SCHEMA, followup=followup,
+                                              accept=is_valid_header)
+
+            if debug:
+                print("STRUCTURED EXTRACTION ATTEMPT:")
+                print(response_text)
+            try:
+                extracted_data = HeaderSchema.model_validate_json(response_text).model_dump()
+                break
+            except ValidationError as e:
+                if attempt:
+                    raise
+                # Rare (e.g. a reply cut off at the token limit): retry once, showing the
+                # model its reply and what was wrong with it
+                print(f"  ⚠️  Invalid header JSON, retrying: {e.error_count()} errors")
+                followup = [
+                    {'role': 'assistant', 'content': response_text},
+                    {'role': 'user', 'content': f"That reply did not match the schema:\n{e}\nReturn the corrected JSON only."},
+                ]
 
         if debug:
             print("SUCCESSFULLY PARSED JSON:")
@@ -321,7 +469,8 @@ def ollama_process_image(image_path, debug=False):
 
         return validated_data
 
-    except (json.JSONDecodeError, ValueError) as e:
+    # ValidationError is a ValueError
+    except ValueError as e:
         if debug:
             print(f"JSON PARSING FAILED: {e}")
             print("Returning debug data...")
@@ -329,93 +478,126 @@ def ollama_process_image(image_path, debug=False):
             print(f"  ❌ JSON PARSING ERROR: {e}")
 
         # Return all fields marked as failed
-        error_data = {
-            "patient_name": "EXTRACTION_FAILED",
-            "date_of_birth": "EXTRACTION_FAILED",
-            "medical_record_number": "EXTRACTION_FAILED",
-            "gender": "EXTRACTION_FAILED",
-            "admit_date": "EXTRACTION_FAILED",
-            "discharge_date": "EXTRACTION_FAILED",
-            "attending_physician": "EXTRACTION_FAILED",
-            "location": "EXTRACTION_FAILED",
-            "facility_name": "EXTRACTION_FAILED",
-            "facility_address": "EXTRACTION_FAILED",
-            "facility_city": "EXTRACTION_FAILED",
-            "facility_state": "EXTRACTION_FAILED",
-            "facility_zip": "EXTRACTION_FAILED",
-            "document_name": "EXTRACTION_FAILED",
-            "document_status": "EXTRACTION_FAILED",
-            "performed_by": "EXTRACTION_FAILED",
-            "authenticated_by": "EXTRACTION_FAILED"
-        }
-        return error_data
+        return {field: "EXTRACTION_FAILED" for field in HEADER_FIELDS}
 
     except Exception as e:
         if debug:
-            print(f"ERROR processing image {image_path}: {e}")
+            print(f"ERROR processing header image: {e}")
         else:
-            print(f"  ❌ ERROR processing image {image_path}: {e}")
-
-        error_data = {
-            "patient_name": "EXTRACTION_FAILED",
-            "date_of_birth": "EXTRACTION_FAILED",
-            "medical_record_number": "EXTRACTION_FAILED",
-            "gender": "EXTRACTION_FAILED",
-            "admit_date": "EXTRACTION_FAILED",
-            "discharge_date": "EXTRACTION_FAILED",
-            "attending_physician": "EXTRACTION_FAILED",
-            "location": "EXTRACTION_FAILED",
-            "facility_name": "EXTRACTION_FAILED",
-            "facility_address": "EXTRACTION_FAILED",
-            "facility_city": "EXTRACTION_FAILED",
-            "facility_state": "EXTRACTION_FAILED",
-            "facility_zip": "EXTRACTION_FAILED",
-            "document_name": "EXTRACTION_FAILED",
-            "document_status": "EXTRACTION_FAILED",
-            "performed_by": "EXTRACTION_FAILED",
-            "authenticated_by": "EXTRACTION_FAILED"
-        }
-        return error_data
-
-def convert_pdf_to_images(pdf_path, output_folder=IMAGES_FOLDER):
+            print(f"  ❌ ERROR processing header image: {e}")
+        return {field: "EXTRACTION_FAILED" for field in HEADER_FIELDS}
+
+def convert_pdf_to_images(pdf_path):
     """
-    Convert ALL pages of a PDF to PNG images.
-    Returns a list of image paths in page order.
+    Render ALL pages of a PDF in memory: page 1 at HEADER_DPI for the header crop,
+    and every page at PAGE_DPI for text extraction.
+    Returns (page 1 PIL image at HEADER_DPI, list of PIL images in page order);
+    (None, []) if conversion failed.
     """
-    if not os.path.exists(output_folder):
-        os.makedirs(output_folder)
-
-    # Clear any existing PNG/JPG files
-    for fname in os.listdir(output_folder):
-        if fname.lower().endswith((".png", ".jpg", ".jpeg")):
-            os.remove(os.path.join(output_folder, fname))
-
     try:
         # Get page count via pdfinfo_from_path (Poppler must be installed)
         info = pdfinfo_from_path(pdf_path)
         total_pages = info.get("Pages", 0)
 
-        # Convert ALL pages
-        all_images = convert_from_path(pdf_path)
-        image_paths = []
+        first_page = convert_from_path(pdf_path, dpi=HEADER_DPI, first_page=1, last_page=1)[0]
+        # Page 1's text-extraction image is scaled down from the header render instead of
+        # rendering the page a second time
+        scale = PAGE_DPI / HEADER_DPI
+        images = [first_page.resize((round(first_page.width * scale), round(first_page.height * scale)))]
+        if total_pages > 1:
+            images += convert_from_path(pdf_path, dpi=PAGE_DPI, first_page=2)
 
-        for i, image in enumerate(all_images, 1):
-            image_path = os.path.join(output_folder, f"page_{i}.png")
-            image.save(image_path, "PNG")
-            image_paths.append(image_path)
-
-        print(f"  📄 Converted PDF ({total_pages} pages) → {len(image_paths)} images")
-        return image_paths
+        print(f"  📄 Converted PDF ({total_pages} pages) → {len(images)} images")
+        return first_page, images
 
     except Exception as e:
         print(f"  ❌ ERROR converting PDF {pdf_path}: {e}")
-        return []
+        return None, []
+
+async def process_pdf(filename, images, header_image):
+    """Extract header, full text and signature date for one rendered PDF and save its JSON. Returns True on success."""
+    try:
+        # Pages were converted to images by the render task
+        if not images:
+            print("  ❌ ERROR: Failed to convert PDF to images")
+            return False
+
+        # Extract header data from first page
+        print("  📋 Extracting header info...")
+        header_info = await ollama_process_image(header_image, debug=False)
+
+        # Extract full document text from all pages
+        print("  📖 Extracting full document text...")
+        full_text = await extract_full_document_text(images, debug=False)
+
+        # Read the signature date from the last page's text; only ask the vision model
+        # when the OCR'd text doesn't contain the signature line
+        print("  ✍️  Extracting signature date...")
+        sig_date = find_signature_date(full_text, len(images))
+        if sig_date is None:
+            sig_date = await extract_electronic_signature_date(images[-1], debug=False)
+
+        # Combine all results
+        final_data = header_info.copy()
+        final_data["electronically_signed_date"] = sig_date
+        final_data["full_document_text"] = full_text
+        final_data["document_filename"] = filename
+        final_data["processed_timestamp"] = datetime.now().isoformat()
+        final_data["total_pages"] = len(images)
+
+        # Save JSON file
+        json_filename = filename.replace('.pdf', '.json').replace('.PDF', '.json')
+        json_path = os.path.join(JSON_OUTPUT_FOLDER, json_filename)
+
+        with open(json_path, 'w', encoding='utf-8') as f:
+            json.dump(final_data, f, indent=2, ensure_ascii=False)
+
+        patient_name = header_info.get("patient_name", "Unknown")
+        sig_out = sig_date if sig_date != "N/A" else "No signature"
+        text_chars = len(full_text) if full_text != "EXTRACTION_FAILED" else 0
+        print(f"  ✅ SUCCESS: {patient_name} | Sig: {sig_out} | Text: {text_chars} chars")
+        print(f"  💾 Saved: {json_path}")
+        return True
 
-def main():
-    # Ensure folders exist
-    for folder in [IMAGES_FOLDER, JSON_OUTPUT_FOLDER]:
-        if not os.path.exists(folder):
-            os.makedirs(folder)
+    except Exception as e:
+        print(f"  ❌ ERROR processing {filename}: {e}")
+        return False
+
+def render_document(pdf_path):
+    """
+    Render a PDF and crop the first page's header. Runs in a worker thread.
+    Returns (page JPEG bytes in page order, header JPEG bytes); ([], None) if conversion failed.
+    """
+    first_page, pages = convert_pdf_to_images(pdf_path)
+    if not pages:
+        return [], None
+    header_image = image_to_bytes(crop_image_to_header(first_page, crop_fraction=0.33))
+    return [image_to_bytes(page) for page in pages], header_image
+
+async def render_documents(to_process, render_queue):
+    """
+    Render PDFs in order into render_queue, followed by a None sentinel. The queue is bounded,
+    so rendering runs at most PREFETCH_DEPTH documents ahead of extraction.
+    """
+    try:
+        for idx, filename in enumerate(to_process, start=1):
+            pdf_path = os.path.join(SOURCE_FOLDER, filename)
+            try:
+                # Poppler and PIL work in a thread, so the event loop keeps driving Ollama meanwhile
+                images, header_image = await asyncio.to_thread(render_document, pdf_path)
+            except Exception as e:
+                # Counted as a failed conversion; the remaining PDFs still get rendered
+                print(f"  ❌ ERROR rendering {filename}: {e}")
+                images, header_image = [], None
+            await render_queue.put((idx, filename, images, header_image))
+    finally:
+        # Always end the stream, so main() stops waiting even if rendering failed outright
+        await render_queue.put(None)
+
+async def main():
+    # Ensure output folder exists
+    if not os.path.exists(JSON_OUTPUT_FOLDER):
+        os.makedirs(JSON_OUTPUT_FOLDER)
 
     # Load checkpoint
     processed = load_checkpoint()
@@ -438,6 +620,7 @@ def main():
         return
 
     print(f"Found {len(all_pdfs)} total PDFs, {len(to_process)} to process")
+    print(f"Processing up to {OLLAMA_NUM_PARALLEL} PDFs concurrently")
     print("=" * 50)
 
     # Track counts and time
@@ -445,74 +628,49 @@ def main():
     error_count = 0
     start_time = datetime.now()
 
-    for idx, filename in enumerate(to_process, start=1):
-        print(f"[{idx}/{len(to_process)}] Processing: {filename}")
-        pdf_path = os.path.join(SOURCE_FOLDER, filename)
+    # Rendering runs as its own task feeding a bounded queue, so the next PDFs are converted
+    # while the current ones are with the model
+    render_queue = asyncio.Queue(maxsize=PREFETCH_DEPTH)
+    renderer = asyncio.create_task(render_documents(to_process, render_queue))
 
+    # Load both models once up front (an empty generate just loads one), while the first PDFs
+    # render, so no request pays the cold start
+    for model in (MODEL_STRUCTURED, MODEL_FAST):
         try:
-            # Convert all pages to images
-            image_paths = convert_pdf_to_images(pdf_path, IMAGES_FOLDER)
-            if not image_paths:
-                print("  ❌ ERROR: Failed to convert PDF to images")
+            print(f"🔥 Loading model {model}...")
+            await ollama_client.generate(model=model, keep_alive=OLLAMA_KEEP_ALIVE)
+        except Exception as e:
+            print(f"  ⚠️  Could not preload model {model}: {e}")
+
+    async def worker():
+        nonlocal successful_count, error_count
+        while (item := await render_queue.get()) is not None:
+            idx, filename, images, header_image = item
+            print(f"[{idx}/{len(to_process)}] Processing: {filename}")
+
+            if await process_pdf(filename, images, header_image):
+                successful_count += 1
+
+                # Progress update every 25 files
+                if successful_count % 25 == 0:
+                    elapsed = datetime.now() - start_time
+                    avg_time = elapsed.total_seconds() / successful_count
+                    remaining = len(to_process) - successful_count - error_count
+                    est_remaining = avg_time * remaining / 60  # minutes
+                    print(f"  ⏱️  Progress: {successful_count}/{len(to_process)} | Est. remaining: {est_remaining:.1f} min")
+            else:
                 error_count += 1
-                # Mark as processed to avoid retrying failed conversions
-                processed.add(filename)
-                save_checkpoint(processed)
-                continue
-
-            # Extract header data from first page
-            print("  📋 Extracting header info...")
-            header_info = ollama_process_image(image_paths[0], debug=False)
-
-            # Extract signature date from last page
-            print("  ✍️  Extracting signature date...")
-            sig_date = extract_electronic_signature_date(image_paths[-1], debug=False)
-
-            # Extract full document text from all pages
-            print("  📖 Extracting full document text...")
-            full_text = extract_full_document_text(image_paths, debug=False)
-
-            # Combine all results
-            final_data = header_info.copy()
-            final_data["electronically_signed_date"] = sig_date
-            final_data["full_document_text"] = full_text
-            final_data["document_filename"] = filename
-            final_data["processed_timestamp"] = datetime.now().isoformat()
-            final_data["total_pages"] = len(image_paths)
-
-            # Save JSON file
-            json_filename = filename.replace('.pdf', '.json').replace('.PDF', '.json')
-            json_path = os.path.join(JSON_OUTPUT_FOLDER, json_filename)
-            
-            with open(json_path, 'w', encoding='utf-8') as f:
-                json.dump(final_data, f, indent=2, ensure_ascii=False)
-
-            # Mark as processed and update checkpoint
+
+            # Mark as processed (failures too, to avoid infinite retries) and update checkpoint
             processed.add(filename)
             save_checkpoint(processed)
 
-            successful_count += 1
-            patient_name = header_info.get("patient_name", "Unknown")
-            sig_out = sig_date if sig_date != "N/A" else "No signature"
-            text_chars = len(full_text) if full_text != "EXTRACTION_FAILED" else 0
-            print(f"  ✅ SUCCESS: {patient_name} | Sig: {sig_out} | Text: {text_chars} chars")
-            print(f"  💾 Saved: {json_path}")
-
-            # Progress update every 25 files
-            if successful_count % 25 == 0:
-                elapsed = datetime.now() - start_time
-                avg_time = elapsed.total_seconds() / successful_count
-                remaining = len(to_process) - idx
-                est_remaining = avg_time * remaining / 60  # minutes
-                print(f"  ⏱️  Progress: {successful_count}/{len(to_process)} | Est. remaining: {est_remaining:.1f} min")
+        # Hand the end-of-stream sentinel on to the next worker
+        await render_queue.put(None)
 
-        except Exception as e:
-            print(f"  ❌ ERROR processing {filename}: {e}")
-            error_count += 1
-            # Still mark as processed to avoid infinite retries
-            processed.add(filename)
-            save_checkpoint(processed)
-            continue
+    # One worker per server slot, so OLLAMA_NUM_PARALLEL PDFs are extracted side by side
+    await asyncio.gather(*(worker() for _ in range(OLLAMA_NUM_PARALLEL)))
+    await renderer
 
     # Final summary
     total_time = datetime.now() - start_time
@@ -531,7 +689,6 @@ if __name__ == "__main__":
     print("=" * 60)
     print(f"Source folder: {SOURCE_FOLDER}")
     print(f"JSON output folder: {JSON_OUTPUT_FOLDER}")
-    print(f"Images temporary folder: {IMAGES_FOLDER}")
     print(f"Checkpoint file: {CHECKPOINT_FILE}")
     print("=" * 60)
-    main()
\ No newline at end of file
+    asyncio.run(main())
\ No newline at end of file
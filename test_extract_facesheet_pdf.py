@@ -0,0 +1,34 @@
+import os
+import unittest
+import tempfile
+from pathlib import Path
+
+from extract_facesheet_pdf import extract_file_from_hex, extract_many
+
+# A tiny JPEG-looking payload (just the SOI/APP0 magic bytes) as hex
+JPEG_HEX = "ffd8ffe000104a464946"
+
+class ExtractFileFromHexTests(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+
+    def test_accepts_pathlib_output_path(self):
+        output_path = Path(self.tmp.name) / "out.jpg"
+        self.assertTrue(extract_file_from_hex(JPEG_HEX, output_path=output_path))
+        self.assertEqual(output_path.read_bytes(), bytes.fromhex(JPEG_HEX))
+        self.assertFalse(os.path.exists(os.fspath(output_path) + ".tmp"))
+
+    def test_invalid_input_leaves_no_file(self):
+        out_dir = os.path.join(self.tmp.name, "out")
+        self.assertEqual(extract_many([JPEG_HEX, "zz"], out_dir, workers=1), [True, False])
+        self.assertEqual(sorted(os.listdir(out_dir)), ["extracted_file_1.jpg"])
+
+    def test_invalid_input_keeps_existing_file(self):
+        output_path = Path(self.tmp.name) / "keep.bin"
+        output_path.write_bytes(b"old")
+        self.assertFalse(extract_file_from_hex("zz", output_path=output_path))
+        self.assertEqual(output_path.read_bytes(), b"old")
+
+if __name__ == "__main__":
+    unittest.main()